@@ -1,68 +1,185 @@
 import os
-import glob
 import json
-import requests
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import streamlit as st
-import numpy as np
-import cv2
-from ultralytics import YOLO
+from image_quality import compute_scores, classify
+from image_catalog import ImageCatalog, CATALOG_NAME
+from zoom_audit import ZoomPredictionStore, SharedModel
+from query_parser import parse_query, parse_range_query, parse_quality_filters
+from ollama_client import OllamaClient, OllamaError
+from thumbnails import ThumbnailCache
+from duplicate_index import DuplicateIndex, hash_image
+from pipeline_metrics import PipelineTracer
+from feature_store import FeatureStore
+from post_analysis import SharedImage, ResultCache, run_checks
 
 YOLO_MODEL_PATH = "./best.pt"
-yolo_model = YOLO(YOLO_MODEL_PATH)
-OLLAMA_HOST = "http://localhost:11434"
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 MODEL = "llama3.2:3b"
+ARCHIVE_ROOT = "."
+STATION = "47.04"
+CATALOG_DB = os.path.join(ARCHIVE_ROOT, CATALOG_NAME)  # the downloader's catalog when ARCHIVE_ROOT is its LOCAL_ROOT
+CATALOG_SYNC_SECONDS = 60  # how often folders are re-checked for images added outside the downloader
+ZOOM_DB = "zoom_predictions.sqlite"
+HASH_DB = "image_hashes.sqlite"
+FEATURE_DIR = "features"  # built offline by feature_store.py
+THUMBNAIL_DIR = ".thumbnails"
+THUMBNAIL_MAX_BYTES = 2 * 1024 ** 3
+GALLERY_PAGE_SIZE = 12
+GALLERY_COLUMNS = 4
+RESULT_CACHE_SIZE = 512  # per-image results kept across reruns and sessions
+ANALYSIS_TIMEOUTS = {"zoom": 30.0, "quality": 10.0, "duplicates": 5.0}  # seconds per check
+METRICS_LOG = "app_metrics.jsonl"  # one JSON line per request with its stage spans
+METRICS_LOG_MAX_BYTES = 50 * 1024 ** 2  # then rotated to app_metrics.jsonl.1
+METRICS_PROM = "app_metrics.prom"  # Prometheus text file for node_exporter's textfile collector
 
-def verify_zoom_with_yolo(image_path: str, expected_zoom: str) -> dict:
-    try:
-        results = yolo_model(image_path)
-        predicted_class = results[0].names[results[0].probs.top1].lower()
-        is_correct = predicted_class == expected_zoom.lower()
-        return {
-            "predicted_zoom": predicted_class,
-            "matches_expected": is_correct
-        }
-    except Exception as e:
-        return {"error": str(e)}
+@st.cache_resource(show_spinner=False)
+def get_tracer() -> PipelineTracer:
+    # Rolling stage latencies shared by all sessions
+    return PipelineTracer(METRICS_LOG, METRICS_PROM, log_max_bytes=METRICS_LOG_MAX_BYTES)
+
+tracer = get_tracer()
+
+@st.cache_resource(show_spinner=False)
+def get_yolo_model() -> SharedModel:
+    # One per server process; the weights are loaded by the first zoom check that needs them
+    return SharedModel(YOLO_MODEL_PATH)
+
+@st.cache_resource(show_spinner=False)
+def get_ollama_client() -> OllamaClient:
+    # Pooled connection and keep_alive shared by all sessions
+    return OllamaClient(OLLAMA_HOST, MODEL)
+
+@st.cache_resource(show_spinner=False)
+def get_zoom_store() -> ZoomPredictionStore:
+    return ZoomPredictionStore(ZOOM_DB)
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_executor() -> ThreadPoolExecutor:
+    # Shared by all sessions: the checks of the shown image run side by side
+    return ThreadPoolExecutor(max_workers=6, thread_name_prefix="analysis")
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_results() -> ResultCache:
+    # Per-image check results kept across reruns and sessions
+    return ResultCache(RESULT_CACHE_SIZE)
+
+# The checks below run on the analysis executor, so they get their resources
+# passed in instead of calling the st.cache_resource getters from a worker thread.
+
+@tracer.timed("verify_zoom_with_yolo")
+def predict_zoom(image: SharedImage, store: ZoomPredictionStore, model: SharedModel) -> str:
+    # Prefer the batch audit result when it is still current; YOLO is only loaded and run without one
+    stored = store.get(image.path)
+    if stored is not None:
+        return stored["predicted_zoom"]
+    return model.classify(image.image)[0]
+
+@tracer.timed("blur_pink_check")
+def analyze_quality(image: SharedImage) -> dict:
+    # One decode, shared with YOLO, for both the blur and the pink check
+    scores = compute_scores(image.image)
+    scores.update(classify(scores))
+    return scores
+
+@tracer.timed("find_duplicates")
+def find_duplicates(image: SharedImage, index: DuplicateIndex) -> list:
+    # Other archive images that are near-identical to this one; a new image is
+    # hashed from the bytes already in memory instead of reading the file again
+    index.refresh()  # pick up hashes other processes added since the last lookup
+    hashes = index.get(image.path) or hash_image(image.data)
+    return [path for path, _ in index.duplicates_of(image.path, hashes=hashes)]
+
+def verify_zoom_with_yolo(predicted_class: str, expected_zoom: str) -> dict:
+    # Kept apart from predict_zoom so the cached prediction doesn't depend on the query
+    is_correct = predicted_class == expected_zoom.lower()
+    return {
+        "predicted_zoom": predicted_class,
+        "matches_expected": is_correct
+    }
+
+@st.cache_resource(show_spinner=False)
+def open_catalog() -> ImageCatalog:
+    # One handle per server process; rows the downloader adds are visible to the next query
+    return ImageCatalog(CATALOG_DB, ARCHIVE_ROOT)
 
-def is_blurry(image_path, threshold=100.0):
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"Image at {image_path} could not be loaded.")
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-    variance = laplacian.var()
-    return variance < threshold
-
-def is_pink(image_path, pink_threshold=50.0):
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"Image at {image_path} could not be loaded.")
-    (B, G, R) = cv2.split(image)
-    avg_red = np.mean(R)
-    avg_green = np.mean(G)
-    avg_blue = np.mean(B)
-    return avg_red > avg_blue and avg_red > avg_green and avg_blue > avg_green
+@st.cache_data(ttl=CATALOG_SYNC_SECONDS, show_spinner=False)
+def sync_catalog() -> dict:
+    # sync() only re-lists folders whose mtime changed
+    return open_catalog().sync()
 
+def get_catalog() -> ImageCatalog:
+    sync_catalog()
+    return open_catalog()
+
+@st.cache_resource(show_spinner=False)
+def get_duplicate_index() -> DuplicateIndex:
+    return DuplicateIndex(HASH_DB)
+
+@st.cache_resource(show_spinner=False)
+def get_feature_store() -> FeatureStore:
+    # Memory-mapped feature columns; picks up a newer build on the next query
+    return FeatureStore(FEATURE_DIR)
+
+@tracer.timed("get_field_image_path")
 def get_field_image_path(date: str, lens: str, zoom: str) -> dict:
     try:
         date_obj = datetime.strptime(date, "%Y-%m-%d")
-        year = date_obj.strftime("%Y")
-        month = date_obj.strftime("%m")
-        day = date_obj.strftime("%d")
-        base_dir = "47.04"
-        folder_path = os.path.join(base_dir, year, lens, zoom.upper())
-        pattern = f"{year}_{month}_{day}-*-{zoom.lower()}.jpeg"
-        full_pattern = os.path.join(folder_path, pattern)
-        matches = glob.glob(full_pattern)
-        if matches:
-            return {"path": matches[0]}
+        # Best-quality capture of the day when the feature table knows it, else the earliest
+        match = get_feature_store().best_of_day(STATION, lens, zoom, date_obj)
+        match = match or get_catalog().find_exact(STATION, lens, zoom, date_obj)
+        if match:
+            # The zoom asked for (by the rules or the LLM) is what YOLO is checked against
+            return {"path": match["path"], "zoom": zoom.lower()}
         else:
             return {"error": "Image not found for given parameters."}
     except Exception as e:
         return {"error": str(e)}
 
+def as_flag(value):
+    # Small models often send booleans as strings, and "false" is truthy
+    if value is None or isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("true", "yes", "1"):
+        return True
+    if text in ("false", "no", "0"):
+        return False
+    if text in ("", "none", "null"):
+        return None
+    raise ValueError(f"Expected true or false, got {value!r}")
+
+@tracer.timed("get_field_images_in_range")
+def get_field_images_in_range(start_date: str, end_date: str, lens: str, zoom: str,
+                              sharp: bool = None, pink: bool = None) -> dict:
+    try:
+        sharp, pink = as_flag(sharp), as_flag(pink)
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)  # end date is inclusive
+        if sharp is None and pink is None:
+            count = get_catalog().count_range(STATION, lens, zoom, start, end)
+        else:
+            count = get_feature_store().count(STATION, lens, zoom, start, end, sharp=sharp, pink=pink)
+        if count:
+            return {"gallery": {"start_date": start_date, "end_date": end_date,
+                                "lens": lens, "zoom": zoom, "sharp": sharp, "pink": pink, "count": count}}
+        else:
+            return {"error": "No images found in that date range."}
+    except Exception as e:
+        return {"error": str(e)}
+
+def gallery_page(gallery: dict, page: int) -> list:
+    start = datetime.strptime(gallery["start_date"], "%Y-%m-%d")
+    end = datetime.strptime(gallery["end_date"], "%Y-%m-%d") + timedelta(days=1)
+    if gallery.get("sharp") is not None or gallery.get("pink") is not None:
+        return get_feature_store().query(STATION, gallery["lens"], gallery["zoom"], start, end,
+                                         sharp=gallery["sharp"], pink=gallery["pink"],
+                                         limit=GALLERY_PAGE_SIZE, offset=page * GALLERY_PAGE_SIZE)
+    return get_catalog().find_range(STATION, gallery["lens"], gallery["zoom"], start, end,
+                                    limit=GALLERY_PAGE_SIZE, offset=page * GALLERY_PAGE_SIZE)
+
 image_search_tool = {
     "type": "function",
     "function": {
@@ -80,31 +197,67 @@ image_search_tool = {
     }
 }
 
+image_range_tool = {
+    "type": "function",
+    "function": {
+        "name": "get_field_images_in_range",
+        "description": "List all field images for a lens and zoom level between two dates (inclusive).",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "start_date": {"type": "string", "description": "First date in YYYY-MM-DD"},
+                "end_date": {"type": "string", "description": "Last date in YYYY-MM-DD"},
+                "lens": {"type": "string", "description": "Lens name, like K2"},
+                "zoom": {"type": "string", "description": "Zoom level, e.g., 10x"},
+                "sharp": {"type": "boolean", "description": "Only sharp (true) or only blurry (false) images"},
+                "pink": {"type": "boolean", "description": "Only pink-tinted (true) or only normal-colour (false) images"}
+            },
+            "required": ["start_date", "end_date", "lens", "zoom"]
+        }
+    }
+}
+
+@tracer.timed("chat_with_tools")
 def chat_with_tools(user_input: str):
+    # Fast path: a well-formed query needs no LLM round-trip
+    ranged = parse_range_query(user_input)
+    if all(ranged.values()):
+        result = get_field_images_in_range(**ranged, **parse_quality_filters(user_input))
+        result["route"] = "rules"
+        return result
+
+    parsed = parse_query(user_input)
+    if all(parsed.values()):
+        result = get_field_image_path(**parsed)
+        result["route"] = "rules"
+        return result
+
+    result = chat_with_llm(user_input)
+    result["route"] = "llm"
+    return result
+
+@tracer.timed("chat_with_llm")
+def chat_with_llm(user_input: str):
     system_prompt = (
         "You are an assistant that can locate field images based on date, lens, and zoom level.\n"
         "Only call the tool if the user provides enough info (date, lens, zoom).\n"
-        "If you decide to use the function, use this format: [get_field_image_path(date='YYYY-MM-DD', lens='K2', zoom='10x')]\n\n"
-        "Here is a list of available functions:\n\n" + json.dumps([image_search_tool["function"]], indent=2)
+        "If you decide to use the function, use this format: [get_field_image_path(date='YYYY-MM-DD', lens='K2', zoom='10x')]\n"
+        "For a period (a month, a season, or two dates) use get_field_images_in_range instead.\n\n"
+        "Here is a list of available functions:\n\n"
+        + json.dumps([image_search_tool["function"], image_range_tool["function"]], indent=2)
     )
 
-    response = requests.post(
-        f"{OLLAMA_HOST}/api/chat",
-        json={
-            "model": MODEL,
-            "messages": [
+    try:
+        resp_json = get_ollama_client().chat(
+            [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_input},
             ],
-            "tools": [image_search_tool],
-            "stream": False
-        },
-    )
-
-    if response.status_code != 200:
-        return {"error": response.text}
+            tools=[image_search_tool, image_range_tool],
+        )
+    except OllamaError as e:
+        return {"error": str(e)}
 
-    resp_json = response.json()
     tool_calls = resp_json.get("message", {}).get("tool_calls", [])
 
     if not tool_calls:
@@ -113,49 +266,178 @@ def chat_with_tools(user_input: str):
     for call in tool_calls:
         fn = call["function"]["name"]
         args = call["function"]["arguments"]
-        if fn == "get_field_image_path":
-            return get_field_image_path(**args)
+        try:
+            if fn == "get_field_image_path":
+                return get_field_image_path(**args)
+            if fn == "get_field_images_in_range":
+                return get_field_images_in_range(**args)
+        except TypeError as e:
+            return {"error": f"Unexpected arguments for {fn}: {e}"}
     return {"error": "No valid tool function call found."}
 
+@st.cache_resource(show_spinner=False)
+def get_thumbnails() -> ThumbnailCache:
+    return ThumbnailCache(THUMBNAIL_DIR, THUMBNAIL_MAX_BYTES)
+
+@tracer.timed("show_image")
+def show_image(path: str):
+    # Serve a downscaled preview by default; the multi-MB original only on request
+    if st.toggle("Show full-resolution original", key=f"original:{path}"):
+        st.image(path, caption=os.path.basename(path), use_container_width=True)
+        return
+    try:
+        preview = get_thumbnails().get(path, "preview")
+    except Exception:
+        preview = path
+    st.image(preview, caption=os.path.basename(path), use_container_width=True)
+
+@st.cache_resource(show_spinner=False)
+def get_thumbnail_executor() -> ThreadPoolExecutor:
+    # Shared by all sessions: renders the visible page and prefetches the next one
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="thumbs")
+
+def load_thumbnails(paths: list) -> list:
+    thumbs = get_thumbnails()
+    def thumb(path):
+        try:
+            return thumbs.get(path, "thumb")
+        except Exception:
+            return path
+    return list(get_thumbnail_executor().map(thumb, paths))
+
+def prefetch_thumbnails(paths: list):
+    for path in paths:
+        get_thumbnail_executor().submit(get_thumbnails().get, path, "thumb")
+
+def change_gallery_page(delta: int):
+    st.session_state["gallery_page"] += delta
+
+@tracer.timed("show_gallery")
+def show_gallery(gallery: dict):
+    pages = -(-gallery["count"] // GALLERY_PAGE_SIZE)
+    page = min(st.session_state.setdefault("gallery_page", 0), pages - 1)
+
+    filters = []
+    for word in ("sharp", "pink"):
+        if gallery.get(word) is not None:
+            filters.append(word if gallery[word] else f"not {word}")
+    st.success(f"{gallery['count']} images: {gallery['lens']} {gallery['zoom']}, "
+               f"{gallery['start_date']} to {gallery['end_date']}"
+               + (f" ({', '.join(filters)})" if filters else ""))
+    prev_col, info_col, next_col = st.columns([1, 2, 1])
+    prev_col.button("\u2190 Previous", disabled=page == 0, on_click=change_gallery_page, args=(-1,))
+    info_col.caption(f"Page {page + 1} of {pages}")
+    next_col.button("Next \u2192", disabled=page + 1 >= pages, on_click=change_gallery_page, args=(1,))
+
+    # Only the visible page is decoded (as small thumbnails)
+    rows = gallery_page(gallery, page)
+    cols = st.columns(GALLERY_COLUMNS)
+    for i, (row, thumb) in enumerate(zip(rows, load_thumbnails([r["path"] for r in rows]))):
+        with cols[i % GALLERY_COLUMNS]:
+            st.image(thumb, caption=row["taken_at"].replace("T", " "), use_container_width=True)
+
+    if page + 1 < pages:
+        prefetch_thumbnails([r["path"] for r in gallery_page(gallery, page + 1)])
+
+def show_zoom_check(predicted_class, error, expected_zoom):
+    if error is not None:
+        st.warning(f"YOLO verification failed: {error}")
+        return
+    verification = verify_zoom_with_yolo(predicted_class, expected_zoom)
+    if verification["matches_expected"]:
+        st.success(f"\u2705 Verified by YOLO: Zoom level is {verification['predicted_zoom']}")
+    else:
+        st.error(f"\u274C Mismatch: YOLO predicted {verification['predicted_zoom']}, but expected {expected_zoom}")
+
+def show_quality_check(quality, error):
+    if error is not None:
+        st.error(f"Quality check failed: {error}")
+        return
+    if quality["blurry"]:
+        st.warning("\u26A0\ufe0f The image appears to be blurry.")
+    elif quality.get("partially_blurry"):
+        st.warning(f"\u26A0\ufe0f Part of the image is blurry "
+                   f"({quality['blurry_tile_fraction']:.0%} of tiles), e.g. condensation on the housing.")
+    else:
+        st.info("The image is sharp.")
+
+    if quality["pink"]:
+        st.warning("\U0001F3A8 The image has a pink tint.")
+    else:
+        st.info("The image color balance looks normal.")
+
+def show_duplicates(duplicates, error):
+    if error is not None:
+        st.warning(f"Duplicate check failed: {error}")
+        return
+    if duplicates:
+        with st.expander(f"Near duplicate of {len(duplicates)} other capture(s)"):
+            for path in duplicates:
+                st.caption(path)
+
+def show_result(result: dict):
+    st.caption("Parsed locally" if result["route"] == "rules" else f"Parsed by {MODEL}")
+    if "gallery" in result:
+        show_gallery(result["gallery"])
+    elif "path" in result:
+        st.success(f"Image found: {result['path']}")
+        expected_zoom = result["zoom"]
+        try:
+            image = SharedImage(result["path"])
+        except OSError as e:
+            st.error(f"Cannot open the image: {e}")
+            return
+        # Resolved here, on the script thread; none of them loads anything heavy
+        store, index, model = get_zoom_store(), get_duplicate_index(), get_yolo_model()
+        checks = run_checks(get_analysis_executor(), image, {
+            "zoom": lambda img: predict_zoom(img, store, model),
+            "quality": analyze_quality,
+            "duplicates": lambda img: find_duplicates(img, index),
+        }, ANALYSIS_TIMEOUTS, cache=get_analysis_results())
+
+        show_image(result["path"])
+        # Fixed slots keep the layout stable while results arrive in any order
+        slots = {name: st.empty() for name in ("duplicates", "zoom", "quality")}
+        for name, slot in slots.items():
+            if name != "duplicates":
+                slot.info(f"Running {name} check...")
+        renderers = {
+            "zoom": lambda value, error: show_zoom_check(value, error, expected_zoom),
+            "quality": show_quality_check,
+            "duplicates": show_duplicates,
+        }
+        for name, value, error in checks:
+            with slots[name].container():
+                renderers[name](value, error)
+    else:
+        st.error(result.get("error", "Unknown error occurred."))
+
+def show_debug_panel():
+    with st.sidebar:
+        if not st.toggle("Show stage timings"):
+            return
+        trace = st.session_state.get("last_trace")
+        if trace:
+            st.caption(f"Last request {trace['request_id']}: {trace['total_ms']:.0f} ms")
+            st.table(trace["spans"])
+        st.caption("Rolling latency per stage")
+        st.table([{"stage": stage, **stats} for stage, stats in tracer.snapshot().items()])
+
 # Streamlit UI
 st.set_page_config(page_title="Smart Field Image Search", layout="centered")
 st.title("\U0001F331 Smart Field Image Search")
 
 user_input = st.text_input("Describe the image you want:",
                            "Show me the image from May 23rd 2014 with K2 at 10x zoom.")
-if st.button("Find Image"):
-    with st.spinner("Searching..."):
-        result = chat_with_tools(user_input)
-        if "path" in result:
-            st.success(f"Image found: {result['path']}")
-            st.image(result["path"], caption=os.path.basename(result["path"]), use_container_width=True)
-
-            expected_zoom = "10x" if "10x" in user_input.lower() else "1x"
-
-            verification = verify_zoom_with_yolo(result["path"], expected_zoom)
-            if "error" in verification:
-                st.warning(f"YOLO verification failed: {verification['error']}")
-            else:
-                if verification["matches_expected"]:
-                    st.success(f"\u2705 Verified by YOLO: Zoom level is {verification['predicted_zoom']}")
-                else:
-                    st.error(f"\u274C Mismatch: YOLO predicted {verification['predicted_zoom']}, but expected {expected_zoom}")
-
-            # Extra filters
-            try:
-                if is_blurry(result["path"]):
-                    st.warning("\u26A0\ufe0f The image appears to be blurry.")
-                else:
-                    st.info("The image is sharp.")
-            except Exception as e:
-                st.error(f"Blur check failed: {e}")
-
-            try:
-                if is_pink(result["path"]):
-                    st.warning("\U0001F3A8 The image has a pink tint.")
-                else:
-                    st.info("The image color balance looks normal.")
-            except Exception as e:
-                st.error(f"Pink tint check failed: {e}")
-        else:
-            st.error(result.get("error", "Unknown error occurred."))
+clicked = st.button("Find Image")
+if clicked or st.session_state.get("result") is not None:
+    with tracer.request("find_image" if clicked else "rerender") as trace:
+        if clicked:
+            with st.spinner("Searching..."):
+                # Kept in session state so toggles (e.g. full resolution) don't lose the result
+                st.session_state["result"] = chat_with_tools(user_input)
+                st.session_state["gallery_page"] = 0
+        show_result(st.session_state["result"])
+    st.session_state["last_trace"] = trace.as_dict()
+
+show_debug_panel()
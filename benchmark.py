@@ -0,0 +1,387 @@
+"""
+benchmark.py
+
+Reproducible benchmarks for the project's hot paths, on synthetic data.
+
+• Synthetic field images (sharp noise texture, Gaussian-blurred, pink-tinted)
+  in several resolutions, generated from a fixed seed.
+• is_blurry / is_pink / analyze_image, check_images_recursively and the
+  image catalog lookup behind get_field_image_path on a synthetic 47.04 tree.
+• Zoom classification with best.pt (skipped if ultralytics isn't installed).
+• The downloader's walk-and-select logic (walk_months + plan_month) against
+  an in-process SFTP server serving a TARBIL-shaped tree on localhost.
+
+Results go to a JSON file; `--compare old.json` reports every benchmark that
+got slower than `--tolerance` and exits non-zero, so it can gate a change.
+
+    python benchmark.py --output bench_results.json
+    python benchmark.py --output new.json --compare bench_results.json
+"""
+
+import os
+import io
+import sys
+import glob
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import statistics
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+import paramiko
+
+RESOLUTIONS = {"vga": (640, 480), "hd": (1920, 1080), "5mp": (2592, 1944)}
+SEED = 1234
+
+###############################################################################
+# Synthetic data
+###############################################################################
+
+def synthetic_image(kind: str, size, rng) -> np.ndarray:
+    """BGR uint8 image: 'sharp' texture, 'blurred' copy of it, or 'pink' tinted."""
+    w, h = size
+    base = rng.integers(0, 256, size=(h // 8 + 1, w // 8 + 1, 3), dtype=np.uint8)
+    image = cv2.resize(base, (w, h), interpolation=cv2.INTER_NEAREST).astype(np.int16)
+    # Green-dominant field colours with fine-grained detail
+    image += rng.integers(0, 40, size=image.shape, dtype=np.int16)
+    image[:, :, 1] += 40
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    if kind == "blurred":
+        image = cv2.GaussianBlur(image, (0, 0), sigmaX=6)
+    elif kind == "pink":
+        image = image.astype(np.float32)
+        image[:, :, 2] = image[:, :, 2] * 1.4 + 60   # R
+        image[:, :, 0] = image[:, :, 0] * 1.1 + 30   # B
+        image[:, :, 1] *= 0.6                         # G
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    return image
+
+
+def encode_jpeg(image) -> bytes:
+    ok, buf = cv2.imencode(".jpeg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise RuntimeError("JPEG encoding failed")
+    return buf.tobytes()
+
+
+def build_archive(root, days=60, size=RESOLUTIONS["vga"], station="47.04", lenses=("K2",), year=2014):
+    """Synthetic <root>/<station>/<year>/<lens>/<ZOOM>/YYYY_MM_DD-HH_MM-zoom.jpeg tree."""
+    rng = np.random.default_rng(SEED)
+    kinds = ["sharp", "sharp", "sharp", "blurred", "pink"]
+    encoded = {k: encode_jpeg(synthetic_image(k, size, rng)) for k in dict.fromkeys(kinds)}  # fixed order: same rng draws every run
+    first = datetime(year, 5, 1, 10, 0)
+    paths = []
+    for lens in lenses:
+        for zoom in ("1X", "10X"):
+            folder = os.path.join(root, station, str(year), lens, zoom)
+            os.makedirs(folder, exist_ok=True)
+            for d in range(days):
+                taken = first + timedelta(days=d)
+                path = os.path.join(folder, f"{taken:%Y_%m_%d-%H_%M}-{zoom.lower()}.jpeg")
+                with open(path, "wb") as f:
+                    f.write(encoded[kinds[d % len(kinds)]])
+                paths.append(path)
+    return paths
+
+
+def build_remote_tree(root, months=(5, 6), shots_per_day=12, disk="TARLA-DISK 2014", year=2014,
+                      station="47.04", cameras=("K1", "K2")):
+    """Empty TARBIL-shaped remote tree: one file per capture, both zoom options."""
+    count = 0
+    for camera in cameras:
+        for month in months:
+            folder = os.path.join(root, "share", "TARBIL", disk, str(year), station, camera, str(year), f"{month:02d}")
+            os.makedirs(folder, exist_ok=True)
+            day = datetime(year, month, 1, 6, 0)
+            while day.month == month:
+                for shot in range(shots_per_day):
+                    taken = day + timedelta(minutes=40 * shot)
+                    for option in ("1X", "10X"):
+                        open(os.path.join(folder, f"{camera}_{option}_{taken:%Y-%m-%d-%H_%M}.jpg"), "wb").close()
+                        count += 1
+                day += timedelta(days=1)
+    return count
+
+###############################################################################
+# In-process SFTP server
+###############################################################################
+
+class _StubServer(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class _StubSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _StubSFTPServer(paramiko.SFTPServerInterface):
+    ROOT = None  # set before the server starts
+
+    def _local(self, path):
+        return os.path.join(self.ROOT, self.canonicalize(path).lstrip("/"))
+
+    def canonicalize(self, path):
+        return os.path.normpath("/" + path).replace(os.sep, "/")
+
+    def list_folder(self, path):
+        try:
+            local = self._local(path)
+            out = []
+            for name in os.listdir(local):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            f = open(self._local(path), "rb")
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _StubSFTPHandle(flags)
+        handle.filename = self._local(path)
+        handle.readfile = f
+        return handle
+
+
+@contextlib.contextmanager
+def local_sftp_server(root):
+    """Serve `root` over SFTP on 127.0.0.1; yields the port."""
+    host_key = paramiko.RSAKey.generate(2048)
+    _StubSFTPServer.ROOT = root
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    transports = []
+
+    def accept_loop():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _StubSFTPServer)
+            transport.start_server(server=_StubServer())
+            transports.append(transport)
+
+    thread = threading.Thread(target=accept_loop, daemon=True)
+    thread.start()
+    try:
+        yield listener.getsockname()[1]
+    finally:
+        listener.close()
+        for t in transports:
+            t.close()
+
+###############################################################################
+# Timing
+###############################################################################
+
+def measure(fn, repeat=5, warmup=1, **extra) -> dict:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    result = {
+        "repeat": repeat,
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "min_ms": round(min(samples) * 1000, 3),
+    }
+    result.update(extra)
+    return result
+
+
+def bench_quality(results, workdir, repeat):
+    from image_quality import analyze_image, is_blurry, is_pink, sharpness, sharpness_batch
+
+    rng = np.random.default_rng(SEED)
+    for res_name, size in RESOLUTIONS.items():
+        for kind in ("sharp", "blurred", "pink"):
+            path = os.path.join(workdir, f"{kind}_{res_name}.jpeg")
+            with open(path, "wb") as f:
+                f.write(encode_jpeg(synthetic_image(kind, size, rng)))
+            verdict = analyze_image(path)
+            results[f"is_blurry[{kind},{res_name}]"] = measure(lambda: is_blurry(path), repeat,
+                                                               blurry=verdict["blurry"])
+            results[f"is_pink[{kind},{res_name}]"] = measure(lambda: is_pink(path), repeat, pink=verdict["pink"])
+            results[f"analyze_image[{kind},{res_name}]"] = measure(lambda: analyze_image(path), repeat)
+        results[f"analyze_image_reduce4[{res_name}]"] = measure(lambda: analyze_image(path, reduce=4), repeat)
+
+        grays = [cv2.cvtColor(synthetic_image("sharp", size, rng), cv2.COLOR_BGR2GRAY) for _ in range(8)]
+        results[f"sharpness_x8[{res_name}]"] = measure(lambda: [sharpness(g) for g in grays], repeat)
+        results[f"sharpness_batch_x8[{res_name}]"] = measure(lambda: sharpness_batch(grays), repeat)
+
+
+def bench_archive(results, workdir, repeat):
+    from blur_detect_folder import check_images_recursively
+    from image_catalog import ImageCatalog
+
+    root = os.path.join(workdir, "archive")
+    paths = build_archive(root)
+    errors = os.path.join(workdir, "ERRORS")
+
+    def scan():
+        shutil.rmtree(errors, ignore_errors=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            check_images_recursively(os.path.join(root, "47.04"), errors)
+
+    results["check_images_recursively"] = measure(scan, max(1, repeat // 2), images=len(paths))
+
+    catalog = ImageCatalog(os.path.join(workdir, "catalog.sqlite"), root)
+    results["catalog_sync_full"] = measure(lambda: catalog.sync(), 1, warmup=0, images=len(paths))
+    results["catalog_sync_unchanged"] = measure(lambda: catalog.sync(), repeat)
+    results["get_field_image_path[catalog]"] = measure(
+        lambda: catalog.find_exact("47.04", "K2", "10x", "2014-06-15"), repeat * 20)
+    results["get_field_image_path[glob]"] = measure(
+        lambda: glob.glob(os.path.join(root, "47.04", "2014", "K2", "10X", "2014_06_15-*-10x.jpeg")), repeat * 20)
+    catalog.close()
+    return root
+
+
+def bench_yolo(results, archive_root, repeat):
+    try:
+        from zoom_audit import load_model, classify_batch, classify_paths
+        model = load_model("./best.pt")
+    except Exception as e:
+        results["verify_zoom_with_yolo"] = {"skipped": str(e)}
+        return
+    paths = sorted(glob.glob(os.path.join(archive_root, "47.04", "2014", "K2", "10X", "*.jpeg")))
+    results["verify_zoom_with_yolo"] = measure(lambda: classify_batch(model, paths[:1], 1), repeat)
+    results["zoom_audit_batch32"] = measure(lambda: classify_paths(model, paths[:32], 32), max(1, repeat // 2),
+                                            images=len(paths[:32]))
+
+
+def bench_downloader_walk(results, workdir, repeat):
+    import download_all_years as dl
+    from sftp_pool import open_sftp
+    from remote_manifest import RemoteLister, RemoteManifest
+
+    remote_root = os.path.join(workdir, "remote")
+    files = build_remote_tree(remote_root)
+    local_root = os.path.join(workdir, "local")
+    os.makedirs(local_root, exist_ok=True)
+    dl.LOCAL_ROOT = local_root
+
+    with local_sftp_server(remote_root) as port:
+        def connect():
+            return open_sftp("127.0.0.1", port, "bench", "bench")
+
+        def walk_and_plan(manifest=None):
+            lister = RemoteLister(connect, manifest)
+            inventory = dl.LocalInventory(local_root, clean_partials=False)
+            jobs = 0
+            with contextlib.redirect_stdout(io.StringIO()):
+                for disk, station, year, camera, month, month_path, listing in dl.walk_months(lister):
+                    jobs += sum(1 for _ in dl.plan_month(station, year, camera, month, month_path,
+                                                         listing, inventory))
+            lister.close()
+            return jobs
+
+        jobs = walk_and_plan()
+        results["downloader_walk_and_select"] = measure(walk_and_plan, repeat, remote_files=files, planned=jobs)
+
+        manifest = RemoteManifest(os.path.join(workdir, "manifest.sqlite"))
+        walk_and_plan(manifest)
+        results["downloader_walk_and_select[manifest]"] = measure(lambda: walk_and_plan(manifest), repeat)
+        manifest.close()
+
+###############################################################################
+# Main
+###############################################################################
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Benchmarks whose median got slower than baseline by more than `tolerance`."""
+    slower = []
+    for name, new in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or "median_ms" not in old or "median_ms" not in new:
+            continue
+        ratio = new["median_ms"] / old["median_ms"] if old["median_ms"] else 1.0
+        if ratio > 1 + tolerance:
+            slower.append((name, old["median_ms"], new["median_ms"], ratio))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the project's hot paths on synthetic data.")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="*", choices=["quality", "archive", "yolo", "downloader"],
+                        help="Run only these groups")
+    parser.add_argument("--compare", metavar="BASELINE", help="Previous results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown, e.g. 0.2 = 20%%")
+    args = parser.parse_args(argv)
+    groups = set(args.only or ["quality", "archive", "yolo", "downloader"])
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        if "quality" in groups:
+            bench_quality(results, workdir, args.repeat)
+        if "archive" in groups or "yolo" in groups:
+            archive_root = bench_archive(results, workdir, args.repeat)
+            if "yolo" in groups:
+                bench_yolo(results, archive_root, args.repeat)
+        if "downloader" in groups:
+            bench_downloader_walk(results, workdir, args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    for name, r in results.items():
+        print(f"{name:50s} {r.get('median_ms', r.get('skipped', ''))}")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            slower = compare(report, json.load(f), args.tolerance)
+        for name, old, new, ratio in slower:
+            print(f"REGRESSION {name}: {old} ms -> {new} ms ({ratio:.2f}x)")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,277 @@
-import cv2
 import os
-import numpy as np
+import csv
+import json
 import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from image_quality import decode_image, compute_scores, classify, is_image_file, is_problematic
+from quality_cache import QualityCache
+from duplicate_index import DuplicateIndex, hash_pixels
 
-def is_blurry(image_path, threshold=100.0):
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"Image at {image_path} could not be loaded.")
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-    variance = laplacian.var()
-    return variance < threshold
-
-def is_pink(image_path, pink_threshold=50.0):
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"Image at {image_path} could not be loaded.")
-    (B, G, R) = cv2.split(image)
-    avg_red = np.mean(R)
-    avg_green = np.mean(G)
-    avg_blue = np.mean(B)
-    return avg_red > avg_blue and avg_red > avg_green and avg_blue > avg_green
-
-def check_images_recursively(root_folder, error_folder='ERRORS', threshold=100.0, pink_threshold=50.0):
+RECORD_FIELDS = ["path", "laplacian_var", "mean_b", "mean_g", "mean_r", "blurry", "pink",
+                 "blurry_tile_fraction", "partially_blurry", "duplicate_of", "error"]
+
+def _analyze(image_path, threshold, pink_threshold, reduce, with_hashes=False):
+    # One decode for the scores and, for duplicate flagging, the perceptual hashes
+    image = decode_image(image_path, reduce)
+    result = compute_scores(image)
+    result.update(classify(result, threshold, pink_threshold))
+    if with_hashes:
+        result["phash"], result["dhash"] = hash_pixels(image)
+    return result
+
+def check_images_recursively(root_folder, error_folder='ERRORS', threshold=100.0, pink_threshold=50.0, reduce=1,
+                             cache=None, duplicates=None, partial_blur=False):
     os.makedirs(error_folder, exist_ok=True)  # Make sure ERRORS folder exists
 
     for dirpath, _, filenames in os.walk(root_folder):
         for filename in filenames:
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff')):
+            if is_image_file(filename):
                 image_path = os.path.join(dirpath, filename)
                 try:
-                    blurry = is_blurry(image_path, threshold)
-                    pink = is_pink(image_path, pink_threshold)
+                    st = os.stat(image_path)
+                    result = cache.get(image_path, st, reduce) if cache is not None else None
+                    hashes = duplicates.get(image_path, st) if duplicates is not None else None
+                    if result is not None and (duplicates is None or hashes is not None):
+                        result.update(classify(result, threshold, pink_threshold))
+                    else:
+                        result = _analyze(image_path, threshold, pink_threshold, reduce, duplicates is not None)
+                        if cache is not None:
+                            cache.put(image_path, result, st, reduce)
+                        if duplicates is not None:
+                            hashes = result["phash"], result["dhash"]
 
-                    if blurry or pink:
+                    # Near duplicates are still scored: a static camera repeats the
+                    # scene, not the tint or smear of a particular frame
+                    if duplicates is not None:
+                        original = duplicates.original_of(image_path, st, hashes=hashes)
+                        if original is not None:
+                            print(f"DUPLICATE: {image_path} (of {original})")
+
+                    if is_problematic(result, partial_blur):
                         print(f"PROBLEMATIC: {image_path}")
-                        # Ensure unique name in case of duplicates
-                        dest_filename = os.path.relpath(image_path, root_folder).replace(os.sep, '__')
-                        dest_path = os.path.join(error_folder, dest_filename)
-                        shutil.copy2(image_path, dest_path)
+                        copy_to_error_folder(image_path, root_folder, error_folder)
 
                 except Exception as e:
                     print(f"ERROR processing {image_path}: {e}")
 
-# Set the root of your 47.04 folder here
-folder_path = './47.04'
-check_images_recursively(folder_path)
+def copy_to_error_folder(image_path, root_folder, error_folder):
+    # Ensure unique name in case of duplicates
+    dest_filename = os.path.relpath(image_path, root_folder).replace(os.sep, '__')
+    dest_path = os.path.join(error_folder, dest_filename)
+    shutil.copy2(image_path, dest_path)
+
+###############################################################################
+# Parallel archive scan
+###############################################################################
+
+def iter_image_paths(root_folder, skip=frozenset()):
+    for dirpath, dirnames, filenames in os.walk(root_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if is_image_file(filename):
+                image_path = os.path.join(dirpath, filename)
+                if image_path not in skip:
+                    yield image_path
+
+def drop_partial_line(output_path, chunk_size=64 * 1024):
+    """Cut an interrupted run's half-written last record so new records start on a fresh line."""
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - chunk_size)
+            f.seek(start)
+            newline = f.read(pos - start).rfind(b"\n")
+            if newline != -1:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos != end:
+            f.truncate(pos)
+
+def load_recorded_paths(output_path):
+    """Paths already present in a previous (possibly interrupted) scan output."""
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    with open(output_path, newline='', encoding='utf-8') as f:
+        if output_path.lower().endswith('.csv'):
+            for row in csv.DictReader(f):
+                if row.get("path"):
+                    done.add(row["path"])
+        else:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["path"])
+                except (ValueError, KeyError):
+                    continue
+    return done
+
+def _scan_one(image_path, threshold, pink_threshold, reduce, with_hashes=False):
+    # Runs in a worker process; never raise so one bad file can't stop the scan
+    try:
+        record = {"path": image_path}
+        record.update(_analyze(image_path, threshold, pink_threshold, reduce, with_hashes))
+        return record
+    except Exception as e:
+        return {"path": image_path, "error": str(e)}
+
+def scan_archive(root_folder, output_path, workers=None, max_in_flight=None, threshold=100.0,
+                 pink_threshold=50.0, reduce=1, error_folder=None, cache=None, duplicates=None,
+                 partial_blur=False):
+    """
+    Score every image under `root_folder` on a process pool and append one
+    record per image to `output_path` (.jsonl or .csv) as results complete.
+
+    At most `max_in_flight` images are queued at once so memory stays flat
+    regardless of archive size. Paths already in `output_path` are skipped,
+    so an interrupted scan resumes where it stopped. With a QualityCache,
+    unchanged files are classified from stored scores and never decoded.
+    With a DuplicateIndex, the workers also hash each image from the same
+    decode and near duplicates of an earlier image get `duplicate_of` next to
+    their scores; they are still scored, since pHash ignores tint and smear.
+    Partially blurry images only count as problematic with `partial_blur`.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 4
+    as_csv = output_path.lower().endswith('.csv')
+    # A half-written last record would otherwise be counted as done (CSV) or
+    # have the next record appended onto it (JSONL)
+    drop_partial_line(output_path)
+    done = load_recorded_paths(output_path)
+    if error_folder:
+        os.makedirs(error_folder, exist_ok=True)
+
+    summary = {"skipped": len(done), "scanned": 0, "cached": 0, "duplicates": 0, "problematic": 0, "errors": 0}
+    write_header = as_csv and (not os.path.exists(output_path) or os.path.getsize(output_path) == 0)
+
+    with open(output_path, 'a', newline='', encoding='utf-8') as out, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        writer = csv.DictWriter(out, fieldnames=RECORD_FIELDS) if as_csv else None
+        if write_header:
+            writer.writeheader()
+
+        def emit(record):
+            # The tile map and hashes live in the caches; records only carry the verdicts
+            record = {k: v for k, v in record.items() if k not in ("tile_map", "phash", "dhash")}
+            if writer:
+                writer.writerow(record)
+            else:
+                out.write(json.dumps(record) + "\n")
+            out.flush()
+
+            summary["scanned"] += 1
+            if "error" in record:
+                summary["errors"] += 1
+                print(f"ERROR processing {record['path']}: {record['error']}")
+                return
+            if "duplicate_of" in record:
+                summary["duplicates"] += 1
+            if is_problematic(record, partial_blur):
+                summary["problematic"] += 1
+                print(f"PROBLEMATIC: {record['path']}")
+                if error_folder:
+                    copy_to_error_folder(record["path"], root_folder, error_folder)
+
+        def collect(finished):
+            for future in finished:
+                record = future.result()
+                st = stats.pop(future)
+                if "error" not in record and st is not None:
+                    if cache is not None:
+                        cache.put(record["path"], record, st, reduce, commit=False)
+                    if duplicates is not None:
+                        flag_duplicate(record, st, (record["phash"], record["dhash"]))
+                emit(record)
+            if cache is not None:
+                cache.commit()
+            if duplicates is not None:
+                duplicates.commit()
+
+        def flag_duplicate(record, st, hashes):
+            # Index lookup only; the hashing happened in the worker
+            original = duplicates.original_of(record["path"], st, hashes=hashes, commit=False)
+            if original is not None:
+                record["duplicate_of"] = original
+
+        pending = set()
+        stats = {}
+        for image_path in iter_image_paths(root_folder, done):
+            st = None
+            if cache is not None or duplicates is not None:
+                try:
+                    st = os.stat(image_path)
+                except OSError:
+                    pass  # the worker reports the error
+            if cache is not None and st is not None:
+                scores = cache.get(image_path, st, reduce)
+                hashes = duplicates.get(image_path, st) if duplicates is not None else None
+                # Without stored hashes the image goes to a worker once more to be hashed
+                if scores is not None and (duplicates is None or hashes is not None):
+                    summary["cached"] += 1
+                    scores.update(classify(scores, threshold, pink_threshold))
+                    record = {"path": image_path, **scores}
+                    if duplicates is not None:
+                        flag_duplicate(record, st, hashes)
+                    emit(record)
+                    continue
+
+            if len(pending) >= max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            future = pool.submit(_scan_one, image_path, threshold, pink_threshold, reduce, duplicates is not None)
+            stats[future] = st
+            pending.add(future)
+
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+        if duplicates is not None:
+            duplicates.commit()
+
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find blurry or pink images in an image archive.")
+    # Set the root of your 47.04 folder here
+    parser.add_argument("root", nargs="?", default="./47.04")
+    parser.add_argument("--errors", default="ERRORS", help="Folder problematic images are copied to")
+    parser.add_argument("--output", help="Stream per-image records to this .jsonl/.csv and scan in parallel")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    parser.add_argument("--reduce", type=int, default=1, choices=[1, 2, 4, 8])
+    parser.add_argument("--cache", help="SQLite score cache; unchanged images are not decoded again")
+    parser.add_argument("--threshold", type=float, default=100.0)
+    parser.add_argument("--pink-threshold", type=float, default=50.0)
+    parser.add_argument("--reclassify", action="store_true",
+                        help="Only re-apply thresholds to the scores stored in --cache; no image is read")
+    parser.add_argument("--partial-blur", action="store_true",
+                        help="Also treat partially blurry images (e.g. condensation in one corner) as problematic")
+    parser.add_argument("--dedupe", metavar="DB",
+                        help="Perceptual-hash index; near duplicates of an earlier image are flagged with duplicate_of")
+    args = parser.parse_args()
+
+    cache = QualityCache(args.cache) if args.cache else None
+    duplicates = DuplicateIndex(args.dedupe) if args.dedupe else None
+    if args.reclassify:
+        if cache is None:
+            parser.error("--reclassify needs --cache")
+        for path, scores in cache.reclassify(args.threshold, args.pink_threshold, root=args.root):
+            if is_problematic(scores, args.partial_blur):
+                print(f"PROBLEMATIC: {path}")
+    elif args.output:
+        print(scan_archive(args.root, args.output, workers=args.workers, max_in_flight=args.max_in_flight,
+                           threshold=args.threshold, pink_threshold=args.pink_threshold,
+                           reduce=args.reduce, error_folder=args.errors, cache=cache, duplicates=duplicates,
+                           partial_blur=args.partial_blur))
+    else:
+        check_images_recursively(args.root, args.errors, args.threshold, args.pink_threshold,
+                                 reduce=args.reduce, cache=cache, duplicates=duplicates,
+                                 partial_blur=args.partial_blur)
+    if cache is not None:
+        cache.close()
+    if duplicates is not None:
+        duplicates.close()
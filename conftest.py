@@ -0,0 +1 @@
+# Lets a plain `pytest` run from the repository root import the top-level modules.
@@ -1,20 +1,48 @@
 """
-download_images_all_years.py  — version 3
+download_images_all_years.py  — version 4
 
 • Walks every TARLA‑DISK directory on the server.
 • Processes only the years ≥ 2013 (MIN_YEAR = 2013). Any disk/year folder
   earlier than this is skipped, except for TARLA-DISK 2014, where only 2013 and 2014 are allowed.
 • Keeps the same local structure and corruption-handling logic.
+• Files are fetched by a pool of SFTP_CONNECTIONS parallel SFTP connections
+  (sftp_pool.SFTPPool); the walk itself uses one extra connection.
+• Remote listings are cached in a local manifest (remote_manifest.py); only
+  directories whose mtime changed are listed again, and years before
+  MANIFEST_FROZEN_BEFORE are trusted without any round-trip.
+• Files are read into memory with SFTP prefetch, checked (size against the
+  remote listing, JPEG markers, PIL verify) and only then published with an
+  atomic rename; corrupt files go straight to CORRUPTED_DIR.
+• Blur / pink scores are computed from the same in-memory bytes and stored in
+  the shared quality cache, so no second pass over the archive is needed.
+• `--plan PATH` only runs the selection and writes a JSON plan (files, sizes,
+  counts per disk/year/station/camera). No image is transferred, but the
+  listings it fetches are kept in the manifest under LOCAL_ROOT so the real
+  run that follows starts from them; real runs print live [METRICS]
+  (files/s, MB/s, listing latency, queue depth, errors) and a final summary.
+• Each month listing is parsed once into sorted per-zoom timestamp arrays and
+  the capture nearest to TARGET_TIME is found by binary search. What already
+  exists locally comes from one walk of LOCAL_ROOT at start-up.
 """
 
+import io
 import os
 import re
+import time
+import json
+import calendar
+import argparse
+import functools
+from bisect import bisect_left
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
-import paramiko
 from PIL import Image
 from dotenv import load_dotenv
-import shutil
+from image_catalog import ImageCatalog, CATALOG_NAME
+from sftp_pool import SFTPPool, open_sftp
+from remote_manifest import RemoteLister, RemoteManifest
+from image_quality import analyze_image, is_problematic
+from quality_cache import QualityCache
+from sync_metrics import SyncMetrics, write_json
 
 ###############################################################################
 # Configuration
@@ -24,183 +52,404 @@ TARGET_TIME     = "10_00"
 TIME_START      = "08_00"
 TIME_END        = "12_00"
 ZOOM_OPTIONS    = ["1X", "10X"]
-MAX_WORKERS     = 4
+SFTP_CONNECTIONS = 4
 LOCAL_ROOT      = "F:/test"
 CORRUPTED_DIR   = os.path.join(LOCAL_ROOT, "corrupted")
+CATALOG_DB      = os.path.join(LOCAL_ROOT, CATALOG_NAME)  # the same file the app reads
+MANIFEST_DB     = os.path.join(LOCAL_ROOT, "remote_manifest.sqlite")
+MANIFEST_FROZEN_BEFORE = datetime.now().year - 1  # older years are closed on the server
+PARTIAL_SUFFIX  = ".part"
+QUALITY_DB      = os.path.join(LOCAL_ROOT, "quality_cache.sqlite")
+QUALITY_REDUCE  = 1      # 2/4/8 scores a reduced-resolution decode (see image_quality)
+QUALITY_ERRORS_DIR = None  # e.g. os.path.join(LOCAL_ROOT, "ERRORS") to copy blurry/pink images there
+QUALITY_PARTIAL_BLUR = False  # also copy partially blurry images (blur_detect_folder --partial-blur)
 
-###############################################################################
-# Environment / connection
-###############################################################################
-load_dotenv()
-hostname = os.getenv("HOSTNAME")
-port     = int(os.getenv("PORT", "22"))
-username = os.getenv("UNAME")
-password = os.getenv("PASSWORD")
-print(f"Connecting to {hostname}:{port} as {username}…")
-
-client = paramiko.SSHClient()
-client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-client.connect(hostname, port=port, username=username, password=password)
-sftp = client.open_sftp()
-
-os.makedirs(CORRUPTED_DIR, exist_ok=True)
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+ROOT_REMOTE = "/share/TARBIL"
+special_2014_years = {"2013", "2014"}
 
 ###############################################################################
 # Helpers
 ###############################################################################
+REMOTE_TIME_RE = re.compile(r"(\d{4}-\d{2}-\d{2})-(\d{2}_\d{2})")
+LOCAL_NAME_RE  = re.compile(r"^(\d{4}_\d{2}_\d{2})-\d{2}_\d{2}-(\d+x)\.jpeg$")
+
 
 def extract_time(filename: str) -> datetime:
-    m = re.search(r"(\d{4}-\d{2}-\d{2})-(\d{2}_\d{2})", filename)
+    m = REMOTE_TIME_RE.search(filename)
     if not m:
         raise ValueError(f"Filename does not match expected pattern: {filename}")
     return datetime.strptime(f"{m.group(1)} {m.group(2)}", "%Y-%m-%d %H_%M")
 
 
-def validate_and_quarantine(path: str) -> None:
+class IncompleteTransfer(Exception):
+    """Fewer bytes arrived than the server says the file holds; not a connection error, so not retried."""
+
+
+def read_remote(sftp, remote_file: str, expected_size=None):
+    """
+    Whole remote file as bytes (prefetched), plus the server's current attributes
+    of it when they were needed: with no `expected_size`, or when the read
+    disagrees with it (the open handle is stat'ed again). Otherwise None.
+    """
+    attrs = None
+    with sftp.open(remote_file, "rb") as f:
+        if expected_size is None:
+            attrs = f.stat()
+            expected_size = attrs.st_size
+        f.prefetch(expected_size)
+        data = f.read()
+        if len(data) != expected_size:
+            attrs = f.stat()
+    return data, attrs
+
+
+def jpeg_problem(data: bytes):
+    """Why `data` is not a complete JPEG, or None if it looks fine."""
+    if not data.startswith(b"\xff\xd8"):
+        return "missing JPEG start marker"
+    if not data.rstrip(b"\x00\r\n ").endswith(b"\xff\xd9"):
+        return "missing JPEG end marker (truncated?)"
     try:
-        with Image.open(path) as img:
+        with Image.open(io.BytesIO(data)) as img:
             img.verify()
-    except Exception:
-        print(f"[CORRUPT] {path}")
+    except Exception as exc:
+        return f"PIL verify failed: {exc}"
+    return None
+
+
+def publish(data: bytes, path: str) -> None:
+    """Write `data` to `path` atomically: a crash never leaves a partial image behind."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + PARTIAL_SUFFIX
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def score_download(data: bytes, local_path: str, quality) -> None:
+    """Blur / pink scores from the bytes still in memory, stored next to the other scans' results."""
+    try:
+        result = analyze_image(data, reduce=QUALITY_REDUCE)
+    except Exception as exc:
+        print(f"[WARN] Quality scoring failed for {local_path}: {exc}")
+        return
+    quality.put(local_path, result, reduce=QUALITY_REDUCE)
+    if QUALITY_ERRORS_DIR and is_problematic(result, QUALITY_PARTIAL_BLUR):
+        print(f"[PROBLEMATIC] {local_path}")
+        # Same naming as blur_detect_folder's ERRORS copies
+        dest_filename = os.path.relpath(local_path, LOCAL_ROOT).replace(os.sep, "__")
+        publish(data, os.path.join(QUALITY_ERRORS_DIR, dest_filename))
+
+
+def fetch_file(sftp, job, catalog=None, quality=None, metrics=None, manifest=None) -> int:
+    remote_file, local_path, listed_size = job
+    t0 = time.monotonic()
+    data, attrs = read_remote(sftp, remote_file, listed_size)
+    t1 = time.monotonic()
+    remote_size = attrs.st_size if attrs is not None else listed_size
+    if listed_size is not None and remote_size != listed_size:
+        # The file changed after it was listed: the read is judged against its
+        # current size, and the manifest must not serve the old one again
+        print(f"[CHANGED] {remote_file}: listed {listed_size} bytes, now {remote_size}")
+        if manifest is not None:
+            manifest.update_file(*remote_file.rsplit("/", 1), remote_size, attrs.st_mtime)
+    if len(data) != remote_size:
+        # Nothing published; the next run fetches it again
+        raise IncompleteTransfer(f"got {len(data)} of {remote_size} bytes")
+
+    problem = jpeg_problem(data)
+    t2 = time.monotonic()
+    if metrics is not None:
+        metrics.observe("transfer", t1 - t0)
+        metrics.observe("validation", t2 - t1)
+        metrics.record_file(len(data))
+    if problem:
+        print(f"[CORRUPT] {remote_file}: {problem}")
+        if metrics is not None:
+            metrics.record_error("corrupt")
         try:
-            shutil.move(path, os.path.join(CORRUPTED_DIR, os.path.basename(path)))
+            publish(data, os.path.join(CORRUPTED_DIR, os.path.basename(local_path)))
         except Exception as exc:
             print(f"[ERROR] Failed to quarantine: {exc}")
+        return len(data)
+
+    publish(data, local_path)
+    print(f"[DL] {remote_file} -> {local_path}")
+    if catalog is not None:
+        catalog.add_file(local_path)
+    if quality is not None:
+        t3 = time.monotonic()
+        score_download(data, local_path, quality)
+        if metrics is not None:
+            metrics.observe("scoring", time.monotonic() - t3)
+    return len(data)
+
+
+def report_failure(job, exc, metrics=None) -> None:
+    print(f"[ERROR] Download failed: {job[0]} -> {exc}")
+    if metrics is not None:
+        metrics.record_error(type(exc).__name__)
+
+
+class LocalInventory:
+    """
+    (station, year, camera, option, day_key) of every local image, from one
+    walk of `root`. Leftover partial files from an interrupted run are removed.
+    """
+
+    def __init__(self, root: str, clean_partials: bool = True):
+        self._have = set()
+        for dirpath, _, filenames in os.walk(root):
+            for f in filenames:
+                if clean_partials and f.endswith(PARTIAL_SUFFIX):
+                    os.remove(os.path.join(dirpath, f))
+            parts = os.path.relpath(dirpath, root).split(os.sep)
+            if len(parts) != 4:
+                continue
+            station, year, camera, option = parts
+            for f in filenames:
+                m = LOCAL_NAME_RE.match(f)
+                if m and m.group(2) == option.lower():
+                    self._have.add((station, year, camera, option, m.group(1)))
 
+    def __len__(self):
+        return len(self._have)
 
-def should_download(local_dir: str, day_key: str, option: str) -> bool:
-    if not os.path.exists(local_dir):
-        return True
-    pattern = re.compile(fr"^{day_key}-\d{{2}}_\d{{2}}-{option.lower()}\.jpeg$")
-    return not any(pattern.match(f) for f in os.listdir(local_dir) if f.lower().endswith(".jpeg"))
-
-###############################################################################
-# Walk remote tree
-###############################################################################
-ROOT_REMOTE = "/share/TARBIL"
-special_2014_years = {"2013", "2014"}
+    def has(self, station, year, camera, option, day_key) -> bool:
+        return (station, year, camera, option, day_key) in self._have
 
-disk_dirs = [
-    d for d in sftp.listdir(ROOT_REMOTE)
-    if d.startswith("TARLA-DISK")
-]
+    def add(self, station, year, camera, option, day_key) -> None:
+        self._have.add((station, year, camera, option, day_key))
 
-for disk in sorted(disk_dirs):
-    disk_path = f"{ROOT_REMOTE}/{disk}"
-    try:
-        all_years = sftp.listdir(disk_path)
-    except Exception:
-        continue
 
-    if disk == "TARLA-DISK 2014":
-        year_dirs = [y for y in all_years if y in special_2014_years]
-    else:
-        year_dirs = [y for y in all_years if re.fullmatch(r"\d{4}", y) and int(y) >= MIN_YEAR]
+def index_month(files) -> dict:
+    """option -> (sorted capture times, matching file names); each name is parsed once."""
+    entries = {option: [] for option in ZOOM_OPTIONS}
+    for fname in sorted(files):
+        options = [o for o in ZOOM_OPTIONS if o in fname]
+        if not options:
+            continue
+        try:
+            dt = extract_time(fname)
+        except ValueError:
+            continue
+        for option in options:
+            entries[option].append((dt, fname))
+
+    index = {}
+    for option, pairs in entries.items():
+        pairs.sort(key=lambda p: p[0])  # stable: equal times keep name order
+        index[option] = ([dt for dt, _ in pairs], [f for _, f in pairs])
+    return index
+
+
+def select_capture(times, names, target: datetime, start: datetime, end: datetime):
+    """(time, name) of the capture nearest `target` if it lies in [start, end], else None."""
+    i = bisect_left(times, target)
+    if i < len(times) and times[i] == target:
+        return times[i], names[i]
+    best = None
+    for j in (i - 1, i):  # earlier neighbour first so it wins ties
+        if 0 <= j < len(times):
+            if best is None or abs(times[j] - target) < abs(times[best] - target):
+                best = j
+    if best is None or not (start <= times[best] <= end):
+        return None
+    return times[best], names[best]
+
+
+def plan_month(station, year, camera, month, month_path, files, inventory):
+    """Yield (remote_file, local_path, remote_size) for every day/option still missing locally."""
+    index = index_month(files)
+    y, m = int(year), int(month)
+    target_h, target_m = map(int, TARGET_TIME.split("_"))
+    start_h, start_m = map(int, TIME_START.split("_"))
+    end_h, end_m = map(int, TIME_END.split("_"))
+
+    for day in range(1, calendar.monthrange(y, m)[1] + 1):
+        day_key = f"{year}_{month}_{day:02d}"
+        target = datetime(y, m, day, target_h, target_m)
+        start = datetime(y, m, day, start_h, start_m)
+        end = datetime(y, m, day, end_h, end_m)
+
+        for option in ZOOM_OPTIONS:
+            if inventory.has(station, year, camera, option, day_key):
+                continue
+            times, names = index[option]
+            picked = select_capture(times, names, target, start, end)
+            if picked is None:
+                continue
 
-    if not year_dirs:
-        continue
+            dt, closest_file = picked
+            local_dir = os.path.join(LOCAL_ROOT, station, year, camera, option)
+            local_filename = f"{day_key}-{dt.strftime('%H_%M')}-{option.lower()}.jpeg"
+            # Mark as taken now so the same day on another disk isn't queued twice
+            inventory.add(station, year, camera, option, day_key)
+            remote_size = files.get(closest_file) if isinstance(files, dict) else None
+            yield f"{month_path}/{closest_file}", os.path.join(local_dir, local_filename), remote_size
 
-    print(f"▶ Disk {disk}  (years: {', '.join(year_dirs)})")
+###############################################################################
+# Walk remote tree
+###############################################################################
 
-    for year in sorted(year_dirs):
-        year_path = f"{disk_path}/{year}"
+def walk_months(sftp):
+    """
+    Yield (disk, station, year, camera, month, month_path, files) for every month
+    folder to sync; `files` maps file name -> remote size. `sftp` is anything
+    with listdir/listdir_attr (an SFTPClient or a RemoteLister).
+    """
+    disk_dirs = [
+        d for d in sftp.listdir(ROOT_REMOTE)
+        if d.startswith("TARLA-DISK")
+    ]
+
+    for disk in sorted(disk_dirs):
+        disk_path = f"{ROOT_REMOTE}/{disk}"
         try:
-            stations = sftp.listdir(year_path)
+            all_years = sftp.listdir(disk_path)
         except Exception:
             continue
 
-        for station in sorted(stations):
-            if not re.fullmatch(r"\d{2}\.\d{2}", station):
-                continue
+        if disk == "TARLA-DISK 2014":
+            year_dirs = [y for y in all_years if y in special_2014_years]
+        else:
+            year_dirs = [y for y in all_years if re.fullmatch(r"\d{4}", y) and int(y) >= MIN_YEAR]
+
+        if not year_dirs:
+            continue
+
+        print(f"▶ Disk {disk}  (years: {', '.join(year_dirs)})")
 
-            station_path = f"{year_path}/{station}"
+        for year in sorted(year_dirs):
+            year_path = f"{disk_path}/{year}"
             try:
-                cameras = sftp.listdir(station_path)
+                stations = sftp.listdir(year_path)
             except Exception:
                 continue
 
-            for camera in sorted(cameras):
-                if not camera.startswith("K"):
+            for station in sorted(stations):
+                if not re.fullmatch(r"\d{2}\.\d{2}", station):
                     continue
 
-                camera_year_path = f"{station_path}/{camera}/{year}"
+                station_path = f"{year_path}/{station}"
                 try:
-                    months = sftp.listdir(camera_year_path)
+                    cameras = sftp.listdir(station_path)
                 except Exception:
                     continue
 
-                for month in sorted(m for m in months if m.isdigit() and len(m) == 2):
-                    month_path = f"{camera_year_path}/{month}"
+                for camera in sorted(cameras):
+                    if not camera.startswith("K"):
+                        continue
+
+                    camera_year_path = f"{station_path}/{camera}/{year}"
                     try:
-                        files = sftp.listdir(month_path)
+                        months = sftp.listdir(camera_year_path)
                     except Exception:
                         continue
 
-                    files.sort()
-                    for day in range(1, 32):
+                    for month in sorted(m for m in months if m.isdigit() and len(m) == 2):
+                        month_path = f"{camera_year_path}/{month}"
                         try:
-                            day_dt = datetime.strptime(f"{year}-{month}-{day:02d} {TARGET_TIME}", "%Y-%m-%d %H_%M")
-                        except ValueError:
+                            files = {a.filename: a.st_size for a in sftp.listdir_attr(month_path)}
+                        except Exception:
                             continue
 
-                        day_key = day_dt.strftime("%Y_%m_%d")
-                        for option in ZOOM_OPTIONS:
-                            local_dir = os.path.join(LOCAL_ROOT, station, year, camera, option)
-                            if not should_download(local_dir, day_key, option):
-                                continue
-
-                            filtered = [f for f in files if option in f]
-                            if not filtered:
-                                continue
-
-                            closest_file = None
-                            closest_diff = float("inf")
-                            exact_found = False
-
-                            for fname in filtered:
-                                try:
-                                    dt = extract_time(fname)
-                                except ValueError:
-                                    continue
-
-                                if dt == day_dt:
-                                    closest_file = fname
-                                    exact_found = True
-                                    break
-
-                                diff = abs((dt - day_dt).total_seconds())
-                                if diff < closest_diff:
-                                    closest_file = fname
-                                    closest_diff = diff
-
-                            if not closest_file:
-                                continue
-
-                            dt = extract_time(closest_file)
-                            if not exact_found:
-                                start_dt = datetime.strptime(f"{year}-{month}-{day:02d} {TIME_START}", "%Y-%m-%d %H_%M")
-                                end_dt = datetime.strptime(f"{year}-{month}-{day:02d} {TIME_END}", "%Y-%m-%d %H_%M")
-                                if not (start_dt <= dt <= end_dt):
-                                    continue
-
-                            os.makedirs(local_dir, exist_ok=True)
-                            time_part = dt.strftime("%H_%M")
-                            local_filename = f"{day_key}-{time_part}-{option.lower()}.jpeg"
-                            local_path = os.path.join(local_dir, local_filename)
-                            remote_file = f"{month_path}/{closest_file}"
-
-                            if os.path.exists(local_path):
-                                continue
-
-                            try:
-                                sftp.get(remote_file, local_path)
-                                print(f"[DL] {remote_file} -> {local_path}")
-                                executor.submit(validate_and_quarantine, local_path)
-                            except Exception as e:
-                                print(f"[ERROR] Download failed: {remote_file} -> {e}")
-
-executor.shutdown(wait=True)
-sftp.close()
-client.close()
-print("[DONE]")
+                        yield disk, station, year, camera, month, month_path, files
+
+###############################################################################
+# Plan-only mode
+###############################################################################
+
+def build_plan(lister, inventory) -> dict:
+    """Everything a real run would fetch, without transferring a byte."""
+    files, groups = [], {}
+    for disk, station, year, camera, month, month_path, listing in walk_months(lister):
+        for remote_file, local_path, remote_size in plan_month(station, year, camera, month,
+                                                               month_path, listing, inventory):
+            files.append({"remote": remote_file, "local": local_path, "size": remote_size})
+            group = groups.setdefault(f"{disk}/{year}/{station}/{camera}", {"files": 0, "bytes": 0})
+            group["files"] += 1
+            group["bytes"] += remote_size or 0
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "files": files,
+        "totals": {"files": len(files), "bytes": sum(f["size"] or 0 for f in files)},
+        "by_disk_year_station_camera": groups,
+    }
+
+###############################################################################
+# Main
+###############################################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync TARLA-DISK field images to LOCAL_ROOT.")
+    parser.add_argument("--plan", metavar="PATH",
+                        help="Only run the selection logic and write the download plan as JSON "
+                             "(remote listings are still cached in the manifest)")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="Seconds between [METRICS] lines")
+    parser.add_argument("--metrics-json", metavar="PATH", help="Keep the latest metrics snapshot in this file")
+    parser.add_argument("--summary", metavar="PATH", help="Write the final run summary JSON here")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    hostname = os.getenv("HOSTNAME")
+    port     = int(os.getenv("PORT", "22"))
+    username = os.getenv("UNAME")
+    password = os.getenv("PASSWORD")
+    print(f"Connecting to {hostname}:{port} as {username}…")
+
+    def connect():
+        return open_sftp(hostname, port, username, password)
+
+    metrics = SyncMetrics()
+    os.makedirs(LOCAL_ROOT, exist_ok=True)  # the manifest lives there, even for --plan
+    manifest = RemoteManifest(MANIFEST_DB)
+    lister = RemoteLister(connect, manifest, frozen_before_year=MANIFEST_FROZEN_BEFORE, observer=metrics.observe)
+
+    if args.plan:
+        inventory = LocalInventory(LOCAL_ROOT, clean_partials=False)
+        plan = build_plan(lister, inventory)
+        write_json(args.plan, plan)
+        print(f"[PLAN] {plan['totals']['files']} files, {plan['totals']['bytes'] / 1e6:.1f} MB -> {args.plan}")
+        lister.close()
+        manifest.close()
+        return
+
+    os.makedirs(CORRUPTED_DIR, exist_ok=True)
+    catalog = ImageCatalog(CATALOG_DB, LOCAL_ROOT)
+    quality = QualityCache(QUALITY_DB)
+    inventory = LocalInventory(LOCAL_ROOT)
+    print(f"[INVENTORY] {len(inventory)} local images")
+
+    fetch = functools.partial(fetch_file, catalog=catalog, quality=quality, metrics=metrics, manifest=manifest)
+    pool = SFTPPool(connect, fetch,
+                    connections=SFTP_CONNECTIONS, on_error=functools.partial(report_failure, metrics=metrics))
+    metrics.start_reporter(args.metrics_interval, queue_depth=lambda: pool.queue_depth, json_path=args.metrics_json)
+
+    for disk, station, year, camera, month, month_path, files in walk_months(lister):
+        for job in plan_month(station, year, camera, month, month_path, files, inventory):
+            pool.submit(job)
+
+    pool.close()
+    metrics.stop()
+    report = pool.report()
+    for conn in report["connections"]:
+        print(f"[STATS] {conn['connection']}: {conn['files']} files, {conn['bytes'] / 1e6:.1f} MB, "
+              f"{conn['mb_per_s']} MB/s, {conn['errors']} errors, {conn['reconnects']} reconnects")
+    summary = metrics.snapshot()
+    summary["pool"] = report
+    summary["listing"] = lister.stats
+    if args.summary:
+        write_json(args.summary, summary)
+    print(f"[SUMMARY] {json.dumps(summary)}")
+    catalog.close()
+    quality.close()
+    lister.close()
+    manifest.close()
+    print("[DONE]")
+
+
+if __name__ == "__main__":
+    main()
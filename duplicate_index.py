@@ -0,0 +1,316 @@
+"""
+duplicate_index.py
+
+Perceptual-hash index of the archive for spotting near-duplicate captures:
+cameras that did not move, repeated captures of the same slot, and files that
+exist on both TARLA-DISK 2014 and a later disk.
+
+Each image gets a 64-bit pHash (DCT of a 32x32 grayscale thumbnail) and a
+64-bit dHash (horizontal gradients of a 9x8 thumbnail), decoded at 1/8 scale
+or taken from pixels the caller has already decoded (hash_pixels).
+Both are stored as plain integers in SQLite, keyed by path and reused while
+the file's size and mtime are unchanged. Lookups use multi-index hashing: the
+pHash is split into four 16-bit bands, and by the pigeonhole principle any
+hash within distance r of the query matches one band within r // 4 bits, so
+only a handful of buckets are probed instead of the whole archive.
+"""
+
+import os
+import sqlite3
+import argparse
+import threading
+from array import array
+from itertools import combinations
+import cv2
+import numpy as np
+from image_quality import is_image_file
+
+DEFAULT_DB = "image_hashes.sqlite"
+PHASH_RADIUS = 6    # max pHash bit difference for a near duplicate
+DHASH_RADIUS = 10   # dHash must agree as well, which rules out chance pHash collisions
+BANDS = 4
+BAND_BITS = 64 // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path      TEXT PRIMARY KEY,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    phash     INTEGER NOT NULL,
+    dhash     INTEGER NOT NULL
+)
+"""
+
+
+def _key(path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+# SQLite integers are signed 64-bit
+def _to_signed(h: int) -> int:
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def _to_unsigned(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
+
+
+def _pack_bits(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def hash_image(source):
+    """(phash, dhash) of a path or in-memory encoded image, as unsigned 64-bit ints."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        gray = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        label = "<bytes>"
+    else:
+        label = os.fspath(source)
+        gray = cv2.imread(label, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        raise ValueError(f"Image at {label} could not be loaded.")
+    return hash_pixels(gray)
+
+
+def hash_pixels(image: np.ndarray):
+    """(phash, dhash) of an already decoded grayscale or BGR image, at any scale."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    phash = _pack_bits(low > np.median(low.ravel()[1:]))  # DC term left out of the median
+
+    tiny = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    dhash = _pack_bits(tiny[:, 1:] > tiny[:, :-1])
+    return phash, dhash
+
+
+def _band_probes(value: int, radius: int):
+    """Every BAND_BITS-bit value within `radius` bits of `value`."""
+    yield value
+    for r in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), r):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+
+class DuplicateIndex:
+    """
+    Thread-safe near-duplicate index. Hashes are loaded into memory as packed
+    64-bit arrays on open; entries are numbered in insertion order, so when
+    images are added in archive order the first capture of a group is the
+    one the others are reported as duplicates of.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB, radius=PHASH_RADIUS, dhash_radius=DHASH_RADIUS):
+        self.db_path = db_path
+        self.radius = radius
+        self.dhash_radius = dhash_radius
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+
+        self._paths = []          # id -> path, None once replaced
+        self._ids = {}            # path -> id
+        self._phash = array("Q")
+        self._dhash = array("Q")
+        self._bands = [{} for _ in range(BANDS)]  # band value -> [id]
+        self._stamps = {}         # path -> (size, mtime_ns)
+        self._last_rowid = 0
+        self.refresh()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def refresh(self) -> int:
+        """
+        Load rows written since the last call, e.g. by another process
+        building the index (a replaced row gets a new rowid). Returns the
+        number of entries added or updated.
+        """
+        loaded = 0
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, path, size, mtime_ns, phash, dhash FROM hashes WHERE rowid > ? ORDER BY rowid",
+                (self._last_rowid,)).fetchall()
+            for rowid, path, size, mtime_ns, phash, dhash in rows:
+                self._last_rowid = rowid
+                if self._stamps.get(path) == (size, mtime_ns):
+                    continue  # our own write, already in memory
+                self._insert(path, _to_unsigned(phash), _to_unsigned(dhash))
+                self._stamps[path] = (size, mtime_ns)
+                loaded += 1
+        return loaded
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _insert(self, path, phash, dhash):
+        old = self._ids.get(path)
+        if old is not None:
+            self._paths[old] = None
+        idx = len(self._paths)
+        self._paths.append(path)
+        self._phash.append(phash)
+        self._dhash.append(dhash)
+        self._ids[path] = idx
+        for b, table in enumerate(self._bands):
+            table.setdefault((phash >> (b * BAND_BITS)) & BAND_MASK, []).append(idx)
+        return idx
+
+    def get(self, path, st=None):
+        """Stored (phash, dhash) for `path`, or None if missing or the file changed."""
+        st = st or os.stat(path)
+        key = _key(path)
+        with self._lock:
+            if self._stamps.get(key) != (st.st_size, st.st_mtime_ns):
+                return None
+            idx = self._ids[key]
+            return self._phash[idx], self._dhash[idx]
+
+    def add(self, path, st=None, hashes=None, commit: bool = True):
+        """Index `path` (hashing it unless unchanged or `hashes` is given); returns (phash, dhash)."""
+        st = st or os.stat(path)
+        cached = self.get(path, st)
+        if cached is not None:
+            return cached
+        phash, dhash = hashes or hash_image(path)
+        key = _key(path)
+        with self._lock:
+            self._insert(key, phash, dhash)
+            self._stamps[key] = (st.st_size, st.st_mtime_ns)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                (key, st.st_size, st.st_mtime_ns, _to_signed(phash), _to_signed(dhash)),
+            )
+            if commit:
+                self._conn.commit()
+        return phash, dhash
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def _candidates(self, phash, dhash, radius, dhash_radius):
+        """(id, pHash distance) of every live entry within both radii; caller holds the lock."""
+        seen = set()
+        for b, table in enumerate(self._bands):
+            band = (phash >> (b * BAND_BITS)) & BAND_MASK
+            for probe in _band_probes(band, radius // BANDS):
+                for idx in table.get(probe, ()):
+                    if idx in seen or self._paths[idx] is None:
+                        continue
+                    seen.add(idx)
+                    distance = hamming(phash, self._phash[idx])
+                    if distance <= radius and (dhash is None or hamming(dhash, self._dhash[idx]) <= dhash_radius):
+                        yield idx, distance
+
+    def find(self, phash, dhash=None, radius=None, dhash_radius=None):
+        """[(path, pHash distance)] of indexed images near the given hashes, closest first."""
+        radius = self.radius if radius is None else radius
+        dhash_radius = self.dhash_radius if dhash_radius is None else dhash_radius
+        with self._lock:
+            matches = [(self._paths[idx], d) for idx, d in self._candidates(phash, dhash, radius, dhash_radius)]
+        return sorted(matches, key=lambda m: (m[1], m[0]))
+
+    def duplicates_of(self, path, st=None, hashes=None):
+        """Other indexed images that are near duplicates of `path` (indexing it, with `hashes` if given)."""
+        phash, dhash = self.add(path, st, hashes=hashes)
+        key = _key(path)
+        return [(p, d) for p, d in self.find(phash, dhash) if p != key]
+
+    def original_of(self, path, st=None, hashes=None, commit: bool = True):
+        """
+        Index `path` (with precomputed `hashes` if given) and return the
+        earliest-indexed image it duplicates, or None if it is the first of
+        its kind.
+        """
+        phash, dhash = self.add(path, st, hashes=hashes, commit=commit)
+        key = _key(path)
+        with self._lock:
+            own = self._ids[key]
+            earlier = [idx for idx, _ in self._candidates(phash, dhash, self.radius, self.dhash_radius) if idx < own]
+            return self._paths[min(earlier)] if earlier else None
+
+    def groups(self, root=None):
+        """Lists of near-duplicate paths (two or more each), optionally only under `root`."""
+        prefix = os.path.join(_key(root), "") if root is not None else ""
+        with self._lock:
+            parent = {}
+
+            def find_root(i):
+                while parent.setdefault(i, i) != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+
+            for idx, path in enumerate(self._paths):
+                if path is None or not path.startswith(prefix):
+                    continue
+                for other, _ in self._candidates(self._phash[idx], self._dhash[idx], self.radius, self.dhash_radius):
+                    if other < idx and self._paths[other].startswith(prefix):
+                        parent[find_root(idx)] = find_root(other)
+
+            clusters = {}
+            for idx in list(parent):
+                clusters.setdefault(find_root(idx), []).append(self._paths[idx])
+        return [sorted(paths) for paths in clusters.values() if len(paths) > 1]
+
+    def prune(self):
+        """Drop entries whose file no longer exists; returns the number removed."""
+        with self._lock:
+            missing = [p for p in self._ids if not os.path.exists(p)]
+            for p in missing:
+                self._paths[self._ids.pop(p)] = None
+                self._stamps.pop(p, None)
+            self._conn.executemany("DELETE FROM hashes WHERE path = ?", [(p,) for p in missing])
+            self._conn.commit()
+        return len(missing)
+
+    def build(self, root_folder) -> dict:
+        """Hash every new or modified image under `root_folder`."""
+        summary = {"indexed": 0, "errors": 0}
+        for dirpath, dirnames, filenames in os.walk(root_folder):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not is_image_file(filename):
+                    continue
+                image_path = os.path.join(dirpath, filename)
+                try:
+                    self.add(image_path, commit=False)
+                    summary["indexed"] += 1
+                except (OSError, ValueError) as e:
+                    summary["errors"] += 1
+                    print(f"ERROR hashing {image_path}: {e}")
+            self.commit()
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the archive by perceptual hash and list near duplicates.")
+    parser.add_argument("root", nargs="?", default="./47.04")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--radius", type=int, default=PHASH_RADIUS, help="Max pHash bit difference")
+    args = parser.parse_args()
+
+    with DuplicateIndex(args.db, radius=args.radius) as index:
+        print(index.build(args.root))
+        for group in index.groups(args.root):
+            print(f"{len(group)} near duplicates:")
+            for path in group:
+                print(f"    {path}")
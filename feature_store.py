@@ -0,0 +1,390 @@
+"""
+feature_store.py
+
+Columnar per-image feature table for archive-wide queries without decoding.
+
+An offline build joins the image catalog (station, lens, zoom, capture time)
+with the quality cache (Laplacian variance, blurry-tile share, channel means)
+and the zoom prediction store, and appends one row per image to a set of flat
+NumPy column files:
+
+    <dir>/meta.json      row count, column dtypes, string code tables
+    <dir>/paths.txt      one path per row
+    <dir>/<column>.bin   raw little-endian column data
+
+Columns are opened as read-only memory maps, so a filter such as "sharp,
+non-pink K2 10x captures from summer 2015" is a handful of vectorised NumPy
+comparisons. New or modified files are appended (a modified file's old row is
+marked dead), and meta.json is replaced last, so an interrupted build leaves
+the previous table intact.
+"""
+
+import os
+import json
+import argparse
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from image_quality import BLUR_THRESHOLD, PARTIAL_BLUR_FRACTION, analyze_image, blurry_tile_fraction
+from image_catalog import ImageCatalog, TIME_FORMAT, _as_datetime, _as_day
+from sync_metrics import write_json
+
+DEFAULT_DIR = "features"
+NO_CODE = 255  # unknown station / lens / zoom / prediction
+EPOCH = datetime(1970, 1, 1)
+APPEND_CHUNK = 10000
+
+COLUMNS = {
+    "alive": "u1",
+    "station": "u1",
+    "lens": "u1",
+    "zoom": "u1",
+    "taken_at": "<i8",        # minutes since EPOCH
+    "size": "<i8",
+    "mtime_ns": "<i8",
+    "laplacian_var": "<f4",   # NaN when not scored yet
+    "blurry_tile_fraction": "<f4",
+    "mean_b": "<f4",
+    "mean_g": "<f4",
+    "mean_r": "<f4",
+    "predicted_zoom": "u1",
+    "zoom_confidence": "<f4",
+}
+CODED = {"station": "station", "lens": "lens", "zoom": "zoom", "predicted_zoom": "zoom"}
+
+
+def _minutes(value) -> int:
+    return int((_as_datetime(value) - EPOCH).total_seconds() // 60)
+
+
+class FeatureStore:
+    """Thread-safe; readers pick up a newer build via refresh()."""
+
+    def __init__(self, directory=DEFAULT_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._meta_mtime = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        meta_path = self._path("meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self._meta_mtime = os.stat(meta_path).st_mtime_ns
+        else:
+            meta = {"rows": 0, "paths_bytes": 0, "codes": {"station": [], "lens": [], "zoom": []}}
+        rows = meta["rows"]
+        columns = {
+            name: np.memmap(self._path(f"{name}.bin"), dtype=dtype, mode="r", shape=(rows,))
+            if rows else np.empty(0, dtype=dtype)
+            for name, dtype in COLUMNS.items()
+        }
+        paths = []
+        if rows:
+            with open(self._path("paths.txt"), "rb") as f:
+                paths = f.read(meta["paths_bytes"]).decode("utf-8").split("\n")[:rows]
+        row_of = {p: i for i, p in enumerate(paths) if columns["alive"][i]}
+        with self._lock:
+            self._meta, self._columns, self._paths, self._row_of = meta, columns, paths, row_of
+
+    def refresh(self) -> bool:
+        """Reload if another process finished a build since; True if reloaded."""
+        try:
+            mtime = os.stat(self._path("meta.json")).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._meta_mtime:
+            return False
+        self._load()
+        return True
+
+    def __len__(self):
+        return len(self._row_of)
+
+    ###########################################################################
+    # Build
+    ###########################################################################
+
+    def _code(self, kind, value):
+        if value is None:
+            return NO_CODE
+        codes = self._meta["codes"][kind]
+        if value not in codes:
+            if len(codes) >= NO_CODE:
+                raise ValueError(f"Too many distinct {kind} values for a u1 column")
+            codes.append(value)
+        return codes.index(value)
+
+    def _release(self):
+        """Drop this instance's column maps; Windows won't resize a file while it is mapped."""
+        with self._lock:
+            self._columns = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+            self._paths, self._row_of = [], {}
+
+    def _append(self, records):
+        """Append rows, retire the rows they replace, then publish meta.json."""
+        meta = self._meta
+        rows = meta["rows"]
+        replaced = [self._row_of[r["path"]] for r in records if r["path"] in self._row_of]
+        self._release()
+        try:
+            for name, dtype in COLUMNS.items():
+                if name == "alive":
+                    values = np.ones(len(records), dtype=dtype)
+                elif name in CODED:
+                    values = np.array([self._code(CODED[name], r.get(name)) for r in records], dtype=dtype)
+                else:
+                    values = np.array([r.get(name, np.nan) for r in records], dtype=dtype)
+                with open(self._path(f"{name}.bin"), "ab") as f:
+                    size = rows * np.dtype(dtype).itemsize
+                    if f.seek(0, os.SEEK_END) > size:
+                        f.truncate(size)  # drop leftovers of an interrupted build
+                    f.write(values.tobytes())
+
+            encoded = "".join(("\n" if rows or i else "") + r["path"] for i, r in enumerate(records)).encode("utf-8")
+            with open(self._path("paths.txt"), "ab") as f:
+                if f.seek(0, os.SEEK_END) > meta["paths_bytes"]:
+                    f.truncate(meta["paths_bytes"])
+                f.write(encoded)
+
+            if replaced:
+                alive = np.memmap(self._path("alive.bin"), dtype=COLUMNS["alive"], mode="r+", shape=(rows,))
+                alive[replaced] = 0
+                alive.flush()
+
+            meta["rows"] = rows + len(records)
+            meta["paths_bytes"] += len(encoded)
+            meta["columns"] = COLUMNS
+            write_json(self._path("meta.json"), meta)
+        finally:
+            self._load()  # the new table, or the old one if the append failed
+
+    def _retire(self, paths):
+        rows = [self._row_of[p] for p in paths]
+        if not rows:
+            return
+        alive = np.memmap(self._path("alive.bin"), dtype=COLUMNS["alive"], mode="r+", shape=(self._meta["rows"],))
+        alive[rows] = 0
+        alive.flush()
+        write_json(self._path("meta.json"), self._meta)
+        self._load()
+
+    def build(self, catalog, quality=None, zoom_store=None, analyze_missing=False, reduce=1) -> dict:
+        """
+        Bring the table up to date with `catalog`. Unchanged files are skipped
+        unless a quality score or zoom prediction has become available for
+        them since. With `analyze_missing`, unscored images are decoded (and
+        stored in `quality` if given); otherwise their quality columns stay NaN.
+        """
+        summary = {"appended": 0, "unchanged": 0, "removed": 0, "errors": 0}
+        batch, seen = [], set()
+
+        for image in catalog.all_images():
+            path = image["path"]
+            seen.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            row = self._row_of.get(path)
+            unchanged = (row is not None and self._columns["size"][row] == st.st_size
+                         and self._columns["mtime_ns"][row] == st.st_mtime_ns)
+            missing_scores = not unchanged or np.isnan(self._columns["laplacian_var"][row])
+            missing_zoom = not unchanged or self._columns["predicted_zoom"][row] == NO_CODE
+            if unchanged and not (missing_scores and (quality is not None or analyze_missing)) \
+                    and not (missing_zoom and zoom_store is not None):
+                summary["unchanged"] += 1
+                continue
+
+            record = {
+                "path": path,
+                "station": image["station"],
+                "lens": image["lens"],
+                "zoom": image["zoom"],
+                "taken_at": _minutes(image["taken_at"]),
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+            }
+            try:
+                scores = quality.get(path, st, reduce) if quality is not None else None
+                if scores is None and analyze_missing:
+                    scores = (quality.analyze(path, reduce=reduce) if quality is not None
+                              else analyze_image(path, reduce=reduce))
+                prediction = zoom_store.get(path, st) if zoom_store is not None else None
+            except (OSError, ValueError) as e:
+                summary["errors"] += 1
+                print(f"ERROR reading features of {path}: {e}")
+                continue
+
+            if unchanged:
+                if not (missing_scores and scores is not None) and not (missing_zoom and prediction is not None):
+                    summary["unchanged"] += 1  # nothing new to add
+                    continue
+                # keep what the old row already had
+                for name in ("laplacian_var", "blurry_tile_fraction", "mean_b", "mean_g", "mean_r", "zoom_confidence"):
+                    record[name] = self._columns[name][row]
+                code = int(self._columns["predicted_zoom"][row])
+                record["predicted_zoom"] = None if code == NO_CODE else self._meta["codes"]["zoom"][code]
+            if scores is not None:
+                record.update({k: scores[k] for k in ("laplacian_var", "mean_b", "mean_g", "mean_r")})
+                tile_map = scores.get("tile_map")
+                if tile_map is not None:
+                    record["blurry_tile_fraction"] = blurry_tile_fraction(tile_map)
+            if prediction is not None:
+                record["predicted_zoom"] = prediction["predicted_zoom"]
+                record["zoom_confidence"] = prediction["confidence"]
+
+            batch.append(record)
+            if len(batch) >= APPEND_CHUNK:
+                self._append(batch)
+                summary["appended"] += len(batch)
+                batch = []
+
+        if batch:
+            self._append(batch)
+            summary["appended"] += len(batch)
+        removed = [p for p in self._row_of if p not in seen]
+        self._retire(removed)
+        summary["removed"] = len(removed)
+        return summary
+
+    ###########################################################################
+    # Queries
+    ###########################################################################
+
+    def _snapshot(self):
+        self.refresh()
+        with self._lock:
+            return self._meta, self._columns, self._paths
+
+    def _mask(self, meta, cols, station, lens, zoom, start, end):
+        mask = cols["alive"].astype(bool)
+        for name, value in (("station", station), ("lens", lens and lens.upper()), ("zoom", zoom and zoom.lower())):
+            if value is not None:
+                codes = meta["codes"][name]
+                if value not in codes:
+                    return np.zeros_like(mask)
+                mask &= cols[name] == codes.index(value)
+        if start is not None:
+            mask &= cols["taken_at"] >= _minutes(start)
+        if end is not None:
+            mask &= cols["taken_at"] < _minutes(end)
+        return mask
+
+    @staticmethod
+    def _verdicts(cols, idx, threshold):
+        lap = cols["laplacian_var"][idx]
+        r, g, b = cols["mean_r"][idx], cols["mean_g"][idx], cols["mean_b"][idx]
+        scored = ~np.isnan(lap)
+        blurry = lap < threshold
+        partial = ~blurry & (cols["blurry_tile_fraction"][idx] >= PARTIAL_BLUR_FRACTION)
+        pink = (r > b) & (r > g) & (b > g)
+        return scored, blurry, partial, pink
+
+    def _select(self, station, lens, zoom, start, end, sharp, pink, zoom_verified, threshold, partial_blur):
+        meta, cols, paths = self._snapshot()
+        idx = np.flatnonzero(self._mask(meta, cols, station, lens, zoom, start, end))
+        if sharp is not None or pink is not None:
+            scored, is_blurry, is_partial, is_pink = self._verdicts(cols, idx, threshold)
+            keep = scored
+            if sharp is not None:
+                # Partial blur only counts when asked for, as in image_quality.is_problematic
+                unsharp = is_blurry | is_partial if partial_blur else is_blurry
+                keep &= ~unsharp if sharp else unsharp
+            if pink is not None:
+                keep &= is_pink if pink else ~is_pink
+            idx = idx[keep]
+        if zoom_verified is not None:
+            agrees = cols["predicted_zoom"][idx] == cols["zoom"][idx]
+            idx = idx[agrees if zoom_verified else ~agrees & (cols["predicted_zoom"][idx] != NO_CODE)]
+        return meta, cols, paths, idx[np.argsort(cols["taken_at"][idx], kind="stable")]
+
+    def _row(self, meta, cols, paths, i, threshold):
+        def decode(name):
+            code = int(cols[name][i])
+            return None if code == NO_CODE else meta["codes"][CODED[name]][code]
+
+        scored, blurry, partial, pink = (bool(v[0]) for v in self._verdicts(cols, np.array([i]), threshold))
+        lap = float(cols["laplacian_var"][i])
+        return {
+            "path": paths[i],
+            "station": decode("station"),
+            "lens": decode("lens"),
+            "zoom": decode("zoom"),
+            "taken_at": (EPOCH + timedelta(minutes=int(cols["taken_at"][i]))).strftime(TIME_FORMAT),
+            "laplacian_var": lap if scored else None,
+            "blurry": blurry if scored else None,
+            "partially_blurry": partial if scored else None,
+            "pink": pink if scored else None,
+            "predicted_zoom": decode("predicted_zoom"),
+        }
+
+    def query(self, station=None, lens=None, zoom=None, start=None, end=None, sharp=None, pink=None,
+              zoom_verified=None, threshold=BLUR_THRESHOLD, partial_blur=False, limit=None, offset=0):
+        """
+        Captures with start <= taken_at < end matching every given filter, in
+        capture order. sharp / pink / zoom_verified are True, False or None
+        (don't care); images without scores only match when those are None.
+        Partially blurry images only count as not sharp with `partial_blur`.
+        """
+        meta, cols, paths, idx = self._select(station, lens, zoom, start, end, sharp, pink, zoom_verified,
+                                              threshold, partial_blur)
+        idx = idx[offset:None if limit is None else offset + limit]
+        return [self._row(meta, cols, paths, i, threshold) for i in idx]
+
+    def count(self, station=None, lens=None, zoom=None, start=None, end=None, sharp=None, pink=None,
+              zoom_verified=None, threshold=BLUR_THRESHOLD, partial_blur=False) -> int:
+        return len(self._select(station, lens, zoom, start, end, sharp, pink, zoom_verified,
+                                threshold, partial_blur)[3])
+
+    def best_of_day(self, station, lens, zoom, date, threshold=BLUR_THRESHOLD, partial_blur=False):
+        """
+        Best capture on `date`: scored before unscored, then not pink, not
+        blurry (nor partially blurry, with `partial_blur`), zoom confirmed,
+        highest Laplacian variance, earliest. None if the table has no
+        capture that day.
+        """
+        day = _as_day(date)
+        meta, cols, paths = self._snapshot()
+        idx = np.flatnonzero(self._mask(meta, cols, station, lens, zoom, day, day + timedelta(days=1)))
+        if not len(idx):
+            return None
+        scored, blurry, partial, pink = self._verdicts(cols, idx, threshold)
+        if not partial_blur:
+            partial = np.zeros_like(partial)
+        unconfirmed = cols["predicted_zoom"][idx] != cols["zoom"][idx]
+        sharpness = np.nan_to_num(cols["laplacian_var"][idx], nan=0.0)
+        # np.lexsort sorts by the last key first
+        order = np.lexsort((cols["taken_at"][idx], -sharpness, unconfirmed, partial, blurry, pink, ~scored))
+        return self._row(meta, cols, paths, idx[order[0]], threshold)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the columnar per-image feature table.")
+    parser.add_argument("root", nargs="?", default=".", help="Folder that contains the station folders")
+    parser.add_argument("--dir", default=DEFAULT_DIR)
+    parser.add_argument("--catalog", help="Catalog database (default: the one in root)")
+    parser.add_argument("--quality", help="QualityCache database to take scores from")
+    parser.add_argument("--zoom", help="ZoomPredictionStore database to take predictions from")
+    parser.add_argument("--analyze-missing", action="store_true", help="Decode images that have no stored scores")
+    parser.add_argument("--reduce", type=int, default=1, choices=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    from quality_cache import QualityCache
+    from zoom_audit import ZoomPredictionStore
+
+    quality = QualityCache(args.quality) if args.quality else None
+    zoom_store = ZoomPredictionStore(args.zoom) if args.zoom else None
+    with ImageCatalog(args.catalog, args.root) as catalog:
+        catalog.sync()
+        store = FeatureStore(args.dir)
+        print(store.build(catalog, quality, zoom_store, args.analyze_missing, args.reduce))
+        print(f"{len(store)} images in {args.dir}")
+    for handle in (quality, zoom_store):
+        if handle is not None:
+            handle.close()
@@ -0,0 +1,261 @@
+"""
+image_catalog.py
+
+Persistent, indexed catalog of the local field-image archive (SQLite).
+
+Expected layout (same as the downloader's LOCAL_ROOT):
+
+    <root>/<station>/<year>/<lens>/<ZOOM>/YYYY_MM_DD-HH_MM-<zoom>.jpeg
+
+Every file name is parsed once into station, year, lens, zoom and capture
+time. Lookups by exact date, nearest capture time and date range are B-tree
+range scans on (station, lens, zoom, taken_at) — no directory listing at
+query time. `sync()` only re-lists leaf folders whose mtime changed, and the
+downloader calls `add_file()` for every image it publishes.
+
+Paths are stored relative to the root and the database lives in the root by
+default, so the downloader and the app share one catalog whichever working
+directory they run from; lookups return paths joined back onto the root.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import argparse
+from datetime import datetime, timedelta
+
+CATALOG_NAME = "image_catalog.sqlite"  # default database, inside the archive root
+SCHEMA_VERSION = 1  # 1: paths relative to the root
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+FILENAME_RE = re.compile(r"^(\d{4})_(\d{2})_(\d{2})-(\d{2})_(\d{2})-(\d+x)\.jpeg$", re.IGNORECASE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path      TEXT PRIMARY KEY,
+    station   TEXT NOT NULL,
+    year      INTEGER NOT NULL,
+    lens      TEXT NOT NULL,
+    zoom      TEXT NOT NULL,
+    taken_at  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_lookup ON images (station, lens, zoom, taken_at);
+CREATE TABLE IF NOT EXISTS folders (
+    path      TEXT PRIMARY KEY,
+    mtime_ns  INTEGER NOT NULL
+);
+"""
+
+_COLUMNS = ("path", "station", "year", "lens", "zoom", "taken_at")
+
+
+def parse_image_path(path, root):
+    """Catalog row (path relative to `root`) for an archive image, or None if `path` doesn't follow the layout."""
+    rel_path = os.path.relpath(path, root)
+    parts = rel_path.split(os.sep)
+    if len(parts) != 5:
+        return None
+    station, year, lens, zoom_dir, filename = parts
+    m = FILENAME_RE.match(filename)
+    if not m or m.group(1) != year or m.group(6).lower() != zoom_dir.lower():
+        return None
+    try:
+        taken_at = datetime(*(int(g) for g in m.groups()[:5]))
+    except ValueError:
+        return None
+    return {
+        "path": rel_path,
+        "station": station,
+        "year": int(year),
+        "lens": lens.upper(),
+        "zoom": zoom_dir.lower(),
+        "taken_at": taken_at.strftime(TIME_FORMAT),
+    }
+
+
+def _as_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def _as_day(value) -> datetime:
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], "%Y-%m-%d")
+    return datetime(value.year, value.month, value.day)
+
+
+class ImageCatalog:
+    """Thread-safe catalog handle; one instance can be shared by threads and sessions."""
+
+    def __init__(self, db_path=None, root="."):
+        self.db_path = db_path or os.path.join(root, CATALOG_NAME)
+        self.root = root
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Older catalogs hold paths as they were given (cwd-relative or absolute);
+            # drop them and let the next sync() list everything again
+            self._conn.execute("DELETE FROM images")
+            self._conn.execute("DELETE FROM folders")
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ###########################################################################
+    # Updates
+    ###########################################################################
+
+    def add_file(self, path) -> bool:
+        row = parse_image_path(path, self.root)
+        if row is None:
+            return False
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+                               tuple(row[c] for c in _COLUMNS))
+            self._conn.commit()
+        return True
+
+    def _relative(self, path) -> str:
+        return os.path.relpath(path, self.root)
+
+    def remove_file(self, path):
+        with self._lock:
+            self._conn.execute("DELETE FROM images WHERE path = ?", (self._relative(path),))
+            self._conn.commit()
+
+    def _sync_folder(self, folder, mtime_ns):
+        rows = []
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file():
+                    row = parse_image_path(entry.path, self.root)
+                    if row is not None:
+                        rows.append(tuple(row[c] for c in _COLUMNS))
+        folder = self._relative(folder)
+        prefix = os.path.join(folder, "")
+        with self._lock:
+            self._conn.execute("DELETE FROM images WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+            self._conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder, mtime_ns))
+            self._conn.commit()
+        return len(rows)
+
+    def sync(self) -> dict:
+        """Bring the catalog up to date, re-listing only leaf folders whose mtime changed."""
+        with self._lock:
+            known = dict(self._conn.execute("SELECT path, mtime_ns FROM folders"))
+        summary = {"folders": 0, "relisted": 0, "images": 0}
+        seen = set()
+
+        def subdirs(path):
+            try:
+                with os.scandir(path) as it:
+                    return sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
+            except OSError:
+                return []
+
+        for station in subdirs(self.root):
+            for year in subdirs(station.path):
+                if not re.fullmatch(r"\d{4}", year.name):
+                    continue
+                for lens in subdirs(year.path):
+                    for zoom in subdirs(lens.path):
+                        summary["folders"] += 1
+                        folder = self._relative(zoom.path)
+                        seen.add(folder)
+                        mtime_ns = zoom.stat().st_mtime_ns
+                        if known.get(folder) != mtime_ns:
+                            summary["relisted"] += 1
+                            summary["images"] += self._sync_folder(zoom.path, mtime_ns)
+
+        # Folders that disappeared since the last sync
+        with self._lock:
+            for folder in set(known) - seen:
+                prefix = os.path.join(folder, "")
+                self._conn.execute("DELETE FROM images WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+                self._conn.execute("DELETE FROM folders WHERE path = ?", (folder,))
+            self._conn.commit()
+        return summary
+
+    ###########################################################################
+    # Lookups
+    ###########################################################################
+
+    def _query(self, sql, params):
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        root = self.root
+        return [dict(zip(_COLUMNS, (os.path.normpath(os.path.join(root, r[0])),) + r[1:])) for r in rows]
+
+    def find_range(self, station, lens, zoom, start, end, limit=None, offset=0):
+        """Captures with start <= taken_at < end, in capture order."""
+        sql = ("SELECT path, station, year, lens, zoom, taken_at FROM images "
+               "WHERE station = ? AND lens = ? AND zoom = ? AND taken_at >= ? AND taken_at < ? "
+               "ORDER BY taken_at")
+        params = [station, lens.upper(), zoom.lower(),
+                  _as_datetime(start).strftime(TIME_FORMAT), _as_datetime(end).strftime(TIME_FORMAT)]
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        return self._query(sql, params)
+
+    def count_range(self, station, lens, zoom, start, end) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM images "
+                "WHERE station = ? AND lens = ? AND zoom = ? AND taken_at >= ? AND taken_at < ?",
+                (station, lens.upper(), zoom.lower(),
+                 _as_datetime(start).strftime(TIME_FORMAT), _as_datetime(end).strftime(TIME_FORMAT)),
+            ).fetchone()[0]
+
+    def find_exact(self, station, lens, zoom, date):
+        """Earliest capture on `date` (a date, datetime or 'YYYY-MM-DD'), or None."""
+        day = _as_day(date)
+        rows = self.find_range(station, lens, zoom, day, day + timedelta(days=1), limit=1)
+        return rows[0] if rows else None
+
+    def find_nearest(self, station, lens, zoom, when):
+        """Capture closest in time to `when`; ties go to the earlier capture."""
+        key = _as_datetime(when).strftime(TIME_FORMAT)
+        base = ("SELECT path, station, year, lens, zoom, taken_at FROM images "
+                "WHERE station = ? AND lens = ? AND zoom = ? ")
+        params = (station, lens.upper(), zoom.lower(), key)
+        before = self._query(base + "AND taken_at <= ? ORDER BY taken_at DESC LIMIT 1", params)
+        after = self._query(base + "AND taken_at > ? ORDER BY taken_at ASC LIMIT 1", params)
+        candidates = before + after
+        if not candidates:
+            return None
+        target = _as_datetime(when)
+        return min(candidates, key=lambda r: abs(_as_datetime(r["taken_at"]) - target))
+
+    def all_images(self):
+        """Every catalogued image, in path order."""
+        return self._query("SELECT path, station, year, lens, zoom, taken_at FROM images ORDER BY path", ())
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the field-image catalog.")
+    parser.add_argument("root", nargs="?", default=".", help="Folder that contains the station folders")
+    parser.add_argument("--db", help=f"Catalog database (default: <root>/{CATALOG_NAME})")
+    args = parser.parse_args()
+
+    with ImageCatalog(args.db, args.root) as catalog:
+        print(catalog.sync())
+        print(f"{len(catalog)} images catalogued")
@@ -0,0 +1,166 @@
+"""
+image_quality.py
+
+Shared blur / pink-tint checks used by the app and the folder scanners.
+
+Every image is decoded exactly once; the Laplacian variance and the per-channel
+means are computed from the same pixel buffer and the blurry / pink verdicts
+are derived from those raw scores.
+
+Sharpness is computed on a float32 Laplacian (exact for 8-bit input) and
+reduced per tile as well as globally, so an image that is sharp overall but
+smeared in one region (condensation on the housing) shows up in the tile map.
+A tile is judged against the image's own median tile rather than the global
+blur threshold, since how much detail a sharp tile holds depends on the
+scene, the zoom and the decode scale.
+"""
+
+import os
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff')
+BLUR_THRESHOLD   = 100.0
+PINK_THRESHOLD   = 50.0
+SHARPNESS_GRID   = (6, 8)   # tile rows, tile columns
+TILE_BLUR_RATIO  = 0.2      # a tile below this share of the median tile variance counts as blurry
+PARTIAL_BLUR_FRACTION = 0.3  # share of blurry tiles that flags an image as partially blurry
+
+# Downscale factor -> cv2 decode flag. The reduced flags let libjpeg skip the
+# IDCT work for the dropped resolution, which is much cheaper than a full decode
+# followed by a resize. Note that the Laplacian variance grows on downscaled
+# images, so blur thresholds tuned at full resolution are conservative here.
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def is_image_file(filename: str) -> bool:
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def decode_image(source, reduce: int = 1) -> np.ndarray:
+    """Decode a path or an in-memory encoded image into a BGR array."""
+    if reduce not in REDUCED_DECODE_FLAGS:
+        raise ValueError(f"Unsupported reduce factor {reduce}; use one of {sorted(REDUCED_DECODE_FLAGS)}")
+    flag = REDUCED_DECODE_FLAGS[reduce]
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flag)
+        label = "<bytes>"
+    else:
+        label = os.fspath(source)
+        image = cv2.imread(label, flag)
+
+    if image is None:
+        raise ValueError(f"Image at {label} could not be loaded.")
+    return image
+
+
+def _tile_view(a: np.ndarray, grid):
+    """(…, rows, tile_h, cols, tile_w) view of the top-left part of `a` that divides evenly."""
+    rows, cols = grid
+    h, w = a.shape[-2:]
+    th, tw = h // rows, w // cols
+    if th == 0 or tw == 0:
+        raise ValueError(f"Image of {w}x{h} is too small for a {rows}x{cols} tile grid")
+    a = a[..., :th * rows, :tw * cols]
+    return a.reshape(a.shape[:-2] + (rows, th, cols, tw))
+
+
+def _variances(lap: np.ndarray, grid):
+    """Global and per-tile variance of the last two axes of a float32 Laplacian stack."""
+    sq = np.square(lap)
+    n = lap.shape[-1] * lap.shape[-2]
+    # float64 accumulators only; the full-size buffers stay float32
+    mean = lap.sum(axis=(-2, -1), dtype=np.float64) / n
+    global_var = sq.sum(axis=(-2, -1), dtype=np.float64) / n - mean ** 2
+
+    tiles, tiles_sq = _tile_view(lap, grid), _tile_view(sq, grid)
+    count = tiles.shape[-3] * tiles.shape[-1]
+    tile_mean = tiles.sum(axis=(-3, -1), dtype=np.float64) / count
+    tile_var = tiles_sq.sum(axis=(-3, -1), dtype=np.float64) / count - tile_mean ** 2
+    return global_var, np.maximum(tile_var, 0).astype(np.float32)
+
+
+def sharpness(gray: np.ndarray, grid=SHARPNESS_GRID):
+    """(global Laplacian variance, rows x cols float32 tile map) for one grayscale image."""
+    lap = cv2.Laplacian(gray, cv2.CV_32F)
+    global_var, tile_map = _variances(lap, grid)
+    return float(global_var), tile_map
+
+
+def sharpness_batch(grays, grid=SHARPNESS_GRID):
+    """
+    Vectorised sharpness for N same-sized grayscale images (list or N x H x W
+    array). Returns (N global variances, N x rows x cols tile maps).
+    """
+    stack = np.asarray(grays, dtype=np.float32)
+    # 3x3 Laplacian (cv2 ksize=1) with cv2's default BORDER_REFLECT_101 padding
+    p = np.pad(stack, ((0, 0), (1, 1), (1, 1)), mode="reflect")
+    lap = p[:, :-2, 1:-1] + p[:, 2:, 1:-1] + p[:, 1:-1, :-2] + p[:, 1:-1, 2:] - 4 * p[:, 1:-1, 1:-1]
+    global_var, tile_map = _variances(lap, grid)
+    return global_var, tile_map
+
+
+def compute_scores(image: np.ndarray, grid=SHARPNESS_GRID) -> dict:
+    """Raw quality scores for an already decoded BGR image."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    variance, tile_map = sharpness(gray, grid)
+    mean_b, mean_g, mean_r = cv2.mean(image)[:3]
+    return {
+        "laplacian_var": variance,
+        "mean_b": float(mean_b),
+        "mean_g": float(mean_g),
+        "mean_r": float(mean_r),
+        "tile_map": tile_map,
+    }
+
+
+def blurry_tile_fraction(tile_map: np.ndarray) -> float:
+    """Share of tiles whose Laplacian variance is below TILE_BLUR_RATIO of the median tile."""
+    cutoff = TILE_BLUR_RATIO * float(np.median(tile_map))
+    return float(np.count_nonzero(tile_map < cutoff)) / tile_map.size
+
+
+def classify(scores: dict, threshold=BLUR_THRESHOLD, pink_threshold=PINK_THRESHOLD) -> dict:
+    """Blurry / pink verdicts from raw scores; no image access needed."""
+    # pink_threshold is accepted for compatibility with the old is_pink()
+    # signature; the tint rule only compares the channel means.
+    r, g, b = scores["mean_r"], scores["mean_g"], scores["mean_b"]
+    verdicts = {
+        "blurry": scores["laplacian_var"] < threshold,
+        "pink": r > b and r > g and b > g,
+    }
+    tile_map = scores.get("tile_map")
+    if tile_map is not None:
+        fraction = blurry_tile_fraction(tile_map)
+        verdicts["blurry_tile_fraction"] = round(fraction, 4)
+        verdicts["partially_blurry"] = not verdicts["blurry"] and fraction >= PARTIAL_BLUR_FRACTION
+    return verdicts
+
+
+def is_problematic(verdicts: dict, partial_blur: bool = False) -> bool:
+    """
+    Whether an image should be set aside: blurry or pink, and with
+    `partial_blur` also partially blurry (opt-in, as it is a softer signal).
+    """
+    return bool(verdicts["blurry"] or verdicts["pink"] or (partial_blur and verdicts.get("partially_blurry")))
+
+
+def analyze_image(source, threshold=BLUR_THRESHOLD, pink_threshold=PINK_THRESHOLD, reduce: int = 1) -> dict:
+    """Decode `source` (path or bytes) once and return scores (incl. tile_map) plus verdicts."""
+    scores = compute_scores(decode_image(source, reduce))
+    scores.update(classify(scores, threshold, pink_threshold))
+    return scores
+
+
+def is_blurry(image_path, threshold=BLUR_THRESHOLD):
+    return analyze_image(image_path, threshold=threshold)["blurry"]
+
+
+def is_pink(image_path, pink_threshold=PINK_THRESHOLD):
+    return analyze_image(image_path, pink_threshold=pink_threshold)["pink"]
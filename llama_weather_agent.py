@@ -1,24 +1,22 @@
+import os
 import requests
 import json
+from ollama_client import OllamaClient
+from tool_dispatch import ToolRegistry
 
-OLLAMA_HOST = "http://localhost:11434"
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+MODEL = "llama3.3:70b-instruct-q3_K_M"
 
-# 1. Define your tool function
-def get_weather(city: str, metric: str = "celsius") -> dict:
-    """Fetch current weather data for a city with unit metric."""
-    res = requests.get(f"https://wttr.in/{city}?format=j1")
-    if res.status_code != 200:
-        return {"error": f"Failed to get weather for {city}"}
-    c = res.json()["current_condition"][0]
-    return {
-        "city": city,
-        "description": c["weatherDesc"][0]["value"],
-        "temperature": c["temp_C" if metric == "celsius" else "temp_F"],
-        "humidity": c["humidity"],
-        "metric": metric,
-    }
+# One pooled client for both chat calls; keep_alive keeps the model loaded between questions
+client = OllamaClient(OLLAMA_HOST, MODEL)
 
-# 2. Define tool metadata as expected by LLaMA 3.3 format
+# Weather endpoint; point WTTR_URL at a local stand-in for testing
+WTTR_URL = os.getenv("WTTR_URL", "https://wttr.in")
+WEATHER_TTL = 600  # seconds a city's conditions are reused
+weather_http = requests.Session()
+tools = ToolRegistry()
+
+# 1. Define tool metadata as expected by LLaMA 3.3 format
 weather_tool = {
     "type": "function",
     "function": {
@@ -39,28 +37,39 @@ weather_tool = {
     },
 }
 
+# 2. Define your tool function; calls are cached per (city, metric) for WEATHER_TTL
+@tools.register(weather_tool, ttl=WEATHER_TTL)
+def get_weather(city: str, metric: str = "celsius") -> dict:
+    """Fetch current weather data for a city with unit metric."""
+    res = weather_http.get(f"{WTTR_URL}/{city}", params={"format": "j1"}, timeout=10)
+    if res.status_code != 200:
+        return {"error": f"Failed to get weather for {city}"}
+    c = res.json()["current_condition"][0]
+    return {
+        "city": city,
+        "description": c["weatherDesc"][0]["value"],
+        "temperature": c["temp_C" if metric == "celsius" else "temp_F"],
+        "humidity": c["humidity"],
+        "metric": metric,
+    }
+
 def chat_with_tools(user_input: str):
     system_prompt = (
         "You are an assistant that can call tools. "
         "Use the provided tool definitions to make structured function calls when needed. "
         "You MUST use the exact tool call format so the API returns tool_calls.\n\n"
         "Available functions:\n" +
-        json.dumps([weather_tool["function"]], indent=2)
+        json.dumps([schema["function"] for schema in tools.schemas], indent=2)
     )
 
     # Step 1: Ask model what tools to call
-    resp = requests.post(
-        f"{OLLAMA_HOST}/api/chat",
-        json={
-            "model": "llama3.3:70b-instruct-q3_K_M",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_input},
-            ],
-            "tools": [weather_tool],
-            "stream": False
-        },
-    ).json()
+    resp = client.chat(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input},
+        ],
+        tools=tools.schemas,
+    )
     print("Raw response from Ollama:", json.dumps(resp, indent=2))
 
     tool_calls = resp["message"].get("tool_calls", [])
@@ -69,38 +78,28 @@ def chat_with_tools(user_input: str):
         print("Assistant:", resp["message"].get("content"))
         return
 
-    # Step 2: Execute all tool calls and collect tool responses
+    # Step 2: Execute all tool calls concurrently and collect tool responses in call order
     tool_messages = []
-    for idx, tool_call in enumerate(tool_calls):
-        fn = tool_call["function"]["name"]
-        args = tool_call["function"]["arguments"]
-        if fn == "get_weather" and "city" in args:
-            result = get_weather(**args)
-            tool_messages.append({
-                "role": "tool",
-                "name": fn,
-                "content": json.dumps(result),
-            })
+    for tool_call, message in zip(tool_calls, tools.dispatch(tool_calls)):
+        if message is None:
+            print("Skipping unknown function or missing args:",
+                  tool_call["function"]["name"], tool_call["function"].get("arguments"))
         else:
-            print("Skipping unknown function or missing args:", fn, args)
+            tool_messages.append(message)
 
-    # Step 3: Send back results for model to summarize
+    # Step 3: Send back results for model to summarize, streaming the answer as it's generated
     final_messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_input},
         resp["message"],
     ] + tool_messages
 
-    final_resp = requests.post(
-        f"{OLLAMA_HOST}/api/chat",
-        json={
-            "model": "llama3.3:70b-instruct-q3_K_M",
-            "messages": final_messages,
-            "stream": False
-        },
-    ).json()
+    print("Final Assistant: ", end="", flush=True)
+    for kind, value in client.chat_stream(final_messages):
+        if kind == "token":
+            print(value, end="", flush=True)
+    print()
 
-    print("Final Assistant:", final_resp["message"]["content"])
-    
-# Example use
-chat_with_tools("What is the weather in Paris and Istanbul in fahrenheit?")
+if __name__ == "__main__":
+    # Example use
+    chat_with_tools("What is the weather in Paris and Istanbul in fahrenheit?")
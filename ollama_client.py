@@ -0,0 +1,130 @@
+"""
+ollama_client.py
+
+Shared client for the Ollama /api/chat endpoint.
+
+One pooled `requests.Session` per client keeps TCP connections open between
+calls, every request has a timeout and transient failures are retried, and
+`keep_alive` keeps the model loaded between questions. `chat_stream` yields
+tokens and tool calls as they arrive; `achat` / `achat_stream` are asyncio
+variants for callers that run an event loop.
+
+The host defaults to $OLLAMA_HOST, so the client can be pointed at a local
+stub server in tests.
+"""
+
+import os
+import json
+import asyncio
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_HOST = "http://localhost:11434"
+DEFAULT_TIMEOUT = (3.05, 300)  # (connect, read) seconds; generation on CPU is slow
+DEFAULT_KEEP_ALIVE = "30m"
+
+
+class OllamaError(RuntimeError):
+    pass
+
+
+class OllamaClient:
+    def __init__(self, host=None, model=None, timeout=DEFAULT_TIMEOUT, retries=2, backoff=0.5,
+                 keep_alive=DEFAULT_KEEP_ALIVE, pool_size=4):
+        self.host = (host or os.getenv("OLLAMA_HOST", DEFAULT_HOST)).rstrip("/")
+        self.model = model
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+
+        retry = Retry(
+            total=retries,
+            # A read error or timeout means the model may still be generating;
+            # resending the POST would queue the same generation twice
+            read=0,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "POST"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _post(self, messages, tools, stream, model, options):
+        payload = {
+            "model": model or self.model,
+            "messages": messages,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+        }
+        if tools:
+            payload["tools"] = tools
+        if options:
+            payload["options"] = options
+        try:
+            response = self.session.post(f"{self.host}/api/chat", json=payload, timeout=self.timeout, stream=stream)
+        except requests.RequestException as e:
+            raise OllamaError(f"Ollama request failed: {e}") from e
+        if response.status_code != 200:
+            text = response.text
+            response.close()
+            raise OllamaError(text)
+        return response
+
+    def chat(self, messages, tools=None, model=None, options=None) -> dict:
+        """Complete (non-streamed) chat response as returned by Ollama."""
+        return self._post(messages, tools, False, model, options).json()
+
+    def chat_stream(self, messages, tools=None, model=None, options=None):
+        """
+        Yield ("token", str), ("tool_call", dict) and finally ("done", chunk)
+        events while the model generates.
+        """
+        with self._post(messages, tools, True, model, options) as response:
+            try:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if "error" in chunk:
+                        raise OllamaError(chunk["error"])
+                    message = chunk.get("message", {})
+                    if message.get("content"):
+                        yield "token", message["content"]
+                    for call in message.get("tool_calls") or []:
+                        yield "tool_call", call
+                    if chunk.get("done"):
+                        yield "done", chunk
+                        return
+            except requests.RequestException as e:
+                raise OllamaError(f"Ollama stream interrupted: {e}") from e
+
+    def warm_up(self, model=None):
+        """Load the model (an empty chat) so the first real question doesn't pay for it."""
+        self.chat([], model=model)
+
+    async def achat(self, messages, tools=None, model=None, options=None) -> dict:
+        return await asyncio.to_thread(self.chat, messages, tools, model, options)
+
+    async def achat_stream(self, messages, tools=None, model=None, options=None):
+        events = self.chat_stream(messages, tools, model, options)
+        done = object()
+        try:
+            while True:
+                event = await asyncio.to_thread(next, events, done)
+                if event is done:
+                    return
+                yield event
+        finally:
+            events.close()
@@ -0,0 +1,147 @@
+"""
+pipeline_metrics.py
+
+Per-stage latency tracing for the search app.
+
+A request (one "Find Image" run) collects a span for every timed stage it
+goes through. Each finished request is appended to a JSON-lines log (moved
+to <log>.1 once it reaches `log_max_bytes`, so at most two files), and the
+rolling per-stage percentiles are rewritten as a Prometheus text file (for
+node_exporter's textfile collector) so a slow request can be pinned on the
+LLM, the lookup, YOLO or the quality checks.
+"""
+
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import contextlib
+import contextvars
+from sync_metrics import LatencyTimer
+
+METRIC_PREFIX = "field_search"
+
+_current = contextvars.ContextVar("pipeline_trace", default=None)
+
+
+class Trace:
+    """Spans of one request, in the order they finished."""
+
+    def __init__(self, name):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started = time.time()
+        self.total_ms = None
+        self.spans = []
+
+    def as_dict(self) -> dict:
+        return {
+            "ts": round(self.started, 3),
+            "request_id": self.request_id,
+            "name": self.name,
+            "total_ms": self.total_ms,
+            "spans": self.spans,
+        }
+
+
+class PipelineTracer:
+    """Thread-safe; one instance is shared by every session of the app."""
+
+    def __init__(self, log_path=None, prom_path=None, window=1000, log_max_bytes=None):
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self.prom_path = prom_path
+        self._window = window
+        self._lock = threading.Lock()
+        self._timers = {}
+        self._errors = {}
+
+    def _observe(self, stage, seconds, failed=False):
+        with self._lock:
+            self._timers.setdefault(stage, LatencyTimer(self._window)).add(seconds)
+            if failed:
+                self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Time a stage; recorded in the current request, if any, and in the rolling stats."""
+        t0 = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            seconds = time.perf_counter() - t0
+            self._observe(stage, seconds, failed)
+            trace = _current.get()
+            if trace is not None:
+                span = {"stage": stage, "ms": round(seconds * 1000, 2)}
+                if failed:
+                    span["error"] = True
+                trace.spans.append(span)
+
+    def timed(self, stage):
+        """Decorator form of span()."""
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    @contextlib.contextmanager
+    def request(self, name="request"):
+        """Collect the spans of one request; the Trace is logged when the block exits."""
+        trace = Trace(name)
+        t0 = time.perf_counter()
+        try:
+            with self.span(name):  # whole-request latency, kept out of its own span list
+                token = _current.set(trace)
+                try:
+                    yield trace
+                finally:
+                    _current.reset(token)
+        finally:
+            trace.total_ms = round((time.perf_counter() - t0) * 1000, 2)
+            self._export(trace)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {stage: dict(t.as_dict(), errors=self._errors.get(stage, 0))
+                    for stage, t in sorted(self._timers.items())}
+
+    def prometheus_text(self) -> str:
+        name = f"{METRIC_PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} Latency of each search pipeline stage (rolling window).",
+                 f"# TYPE {name} summary"]
+        errors = []
+        with self._lock:
+            for stage, t in sorted(self._timers.items()):
+                for q, value in t.quantiles().items():
+                    lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {t.total:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {t.count}')
+                errors.append(f'{METRIC_PREFIX}_stage_errors_total{{stage="{stage}"}} {self._errors.get(stage, 0)}')
+        lines += [f"# TYPE {METRIC_PREFIX}_stage_errors_total counter", *errors]
+        return "\n".join(lines) + "\n"
+
+    def _export(self, trace):
+        if self.log_path:
+            line = json.dumps(trace.as_dict())
+            with self._lock:
+                if self.log_max_bytes and os.path.exists(self.log_path) \
+                        and os.path.getsize(self.log_path) >= self.log_max_bytes:
+                    os.replace(self.log_path, f"{self.log_path}.1")
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        if self.prom_path:
+            text = self.prometheus_text()
+            tmp_path = f"{self.prom_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, self.prom_path)
@@ -0,0 +1,121 @@
+"""
+post_analysis.py
+
+Concurrent checks on one archive image once the app has found it.
+
+The file is read into memory once and decoded once; every check receives the
+same SharedImage. Checks run side by side on a shared executor and come back
+in completion order, each bounded by its own timeout, so the UI can show a
+result as soon as it is ready and a slow model cannot hold up the rest.
+Results are kept in a small LRU keyed by check, path and mtime; a check that
+times out keeps running and stores its result for the next rerun.
+"""
+
+import os
+import time
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+from image_quality import decode_image
+
+_MISSING = object()
+
+
+class SharedImage:
+    """Lazily read / decoded image shared by concurrent checks; each step runs once."""
+
+    def __init__(self, path, reduce: int = 1):
+        self.path = path
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        self._reduce = reduce
+        self._lock = threading.Lock()
+        self._data = None
+        self._image = None
+
+    @property
+    def data(self) -> bytes:
+        with self._lock:
+            if self._data is None:
+                with open(self.path, "rb") as f:
+                    self._data = f.read()
+            return self._data
+
+    @property
+    def image(self):
+        """BGR pixels, decoded from `data` on first use."""
+        data = self.data
+        with self._lock:
+            if self._image is None:
+                self._image = decode_image(data, self._reduce)
+            return self._image
+
+
+class ResultCache:
+    """Thread-safe LRU of check results."""
+
+    def __init__(self, maxsize=512):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+
+def run_checks(executor, shared, checks, timeouts, cache=None, default_timeout=30.0):
+    """
+    Start `checks` ({name: fn(shared) -> value}) on `executor` right away and
+    return an iterator of (name, value, error) in completion order; error is a
+    TimeoutError for a check that passed its timeout. Cached results come
+    first. Results that are dicts with an "error" key are not cached.
+    """
+    start = time.monotonic()
+    ready, futures = [], {}
+    for name, fn in checks.items():
+        key = (name, os.path.normcase(os.path.abspath(shared.path)), shared.mtime_ns)
+        value = cache.get(key, _MISSING) if cache is not None else _MISSING
+        if value is not _MISSING:
+            ready.append((name, value, None))
+            continue
+
+        def task(fn=fn, key=key):
+            value = fn(shared)
+            if cache is not None and not (isinstance(value, dict) and "error" in value):
+                cache.put(key, value)  # also when the caller has given up waiting
+            return value
+
+        # Each task gets a copy of the caller's context so tracing spans land in the request
+        futures[executor.submit(contextvars.copy_context().run, task)] = (name, timeouts.get(name, default_timeout))
+    return _completed(ready, futures, start)
+
+
+def _completed(ready, futures, start):
+    yield from ready
+    deadlines = {f: start + timeout for f, (_, timeout) in futures.items()}
+    pending = set(futures)
+    while pending:
+        next_deadline = min(deadlines[f] for f in pending)
+        done, pending = wait(pending, timeout=max(0.0, next_deadline - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        for f in done:
+            error = f.exception()
+            yield futures[f][0], None if error else f.result(), error
+        now = time.monotonic()
+        for f in [f for f in pending if deadlines[f] <= now]:
+            pending.discard(f)
+            f.cancel()
+            name, timeout = futures[f]
+            yield name, None, TimeoutError(f"{name} did not finish within {timeout:g} s")
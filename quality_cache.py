@@ -0,0 +1,149 @@
+"""
+quality_cache.py
+
+Persistent per-image quality scores (SQLite).
+
+Rows are keyed by path and are only reused while the file's size and mtime
+are unchanged. The raw Laplacian variance and channel means are stored, not
+the verdicts, so new blur / pink thresholds can be applied to the whole
+archive without decoding a single image. The per-tile sharpness map is kept
+as a small float32 blob next to the global scores.
+"""
+
+import os
+import sqlite3
+import threading
+import numpy as np
+from image_quality import analyze_image, classify, BLUR_THRESHOLD, PINK_THRESHOLD
+
+DEFAULT_DB = "quality_cache.sqlite"
+SCORE_FIELDS = ("laplacian_var", "mean_b", "mean_g", "mean_r")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    path          TEXT PRIMARY KEY,
+    size          INTEGER NOT NULL,
+    mtime_ns      INTEGER NOT NULL,
+    reduce        INTEGER NOT NULL,
+    laplacian_var REAL NOT NULL,
+    mean_b        REAL NOT NULL,
+    mean_g        REAL NOT NULL,
+    mean_r        REAL NOT NULL,
+    tile_rows     INTEGER,
+    tile_map      BLOB
+)
+"""
+_COLUMNS = ("path", "size", "mtime_ns", "reduce", *SCORE_FIELDS, "tile_rows", "tile_map")
+
+
+def _key(path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _pack_tiles(tile_map):
+    if tile_map is None:
+        return None, None
+    tile_map = np.asarray(tile_map, dtype=np.float32)
+    return tile_map.shape[0], tile_map.tobytes()
+
+
+def _unpack_tiles(rows, blob):
+    if rows is None or blob is None:
+        return None
+    return np.frombuffer(blob, dtype=np.float32).reshape(rows, -1)
+
+
+class QualityCache:
+    """Thread-safe score store; one instance can be shared by worker threads."""
+
+    def __init__(self, db_path=DEFAULT_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        # Caches written before tile maps existed: add the columns, rows stay NULL
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(scores)")}
+        for column, sql_type in (("tile_rows", "INTEGER"), ("tile_map", "BLOB")):
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE scores ADD COLUMN {column} {sql_type}")
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, path, st=None, reduce: int = 1):
+        """Stored scores for `path`, or None if missing or the file changed."""
+        st = st or os.stat(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, reduce, laplacian_var, mean_b, mean_g, mean_r, tile_rows, tile_map "
+                "FROM scores WHERE path = ?",
+                (_key(path),),
+            ).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns or row[2] != reduce:
+            return None
+        scores = dict(zip(SCORE_FIELDS, row[3:7]))
+        scores["tile_map"] = _unpack_tiles(*row[7:])
+        return scores
+
+    def put(self, path, scores: dict, st=None, reduce: int = 1, commit: bool = True):
+        st = st or os.stat(path)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO scores ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                (_key(path), st.st_size, st.st_mtime_ns, reduce, *(scores[f] for f in SCORE_FIELDS),
+                 *_pack_tiles(scores.get("tile_map"))),
+            )
+            if commit:
+                self._conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def analyze(self, path, threshold=BLUR_THRESHOLD, pink_threshold=PINK_THRESHOLD, reduce: int = 1) -> dict:
+        """Like image_quality.analyze_image, but only decodes new or modified files."""
+        st = os.stat(path)
+        scores = self.get(path, st, reduce)
+        if scores is None:
+            result = analyze_image(path, threshold, pink_threshold, reduce=reduce)
+            self.put(path, result, st, reduce)
+            result["cached"] = False
+            return result
+        scores.update(classify(scores, threshold, pink_threshold))
+        scores["cached"] = True
+        return scores
+
+    def reclassify(self, threshold=BLUR_THRESHOLD, pink_threshold=PINK_THRESHOLD, root=None):
+        """Yield (path, scores + verdicts) for every stored image, optionally under `root`."""
+        query = "SELECT path, laplacian_var, mean_b, mean_g, mean_r, tile_rows, tile_map FROM scores"
+        params = ()
+        if root is not None:
+            prefix = os.path.join(_key(root), "")
+            query += " WHERE substr(path, 1, ?) = ?"
+            params = (len(prefix), prefix)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY path", params).fetchall()
+        for path, *values in rows:
+            scores = dict(zip(SCORE_FIELDS, values[:4]))
+            scores["tile_map"] = _unpack_tiles(*values[4:])
+            scores.update(classify(scores, threshold, pink_threshold))
+            yield path, scores
+
+    def prune(self):
+        """Drop rows whose file no longer exists; returns the number removed."""
+        with self._lock:
+            paths = [p for (p,) in self._conn.execute("SELECT path FROM scores")]
+        missing = [(p,) for p in paths if not os.path.exists(p)]
+        with self._lock:
+            self._conn.executemany("DELETE FROM scores WHERE path = ?", missing)
+            self._conn.commit()
+        return len(missing)
@@ -0,0 +1,138 @@
+"""
+query_parser.py
+
+Rule-based extraction of date, lens and zoom from a search sentence, so
+well-formed requests ("May 23rd 2014 with K2 at 10x") can skip the LLM.
+Date ranges ("May 2014", "summer 2015", "from 1 May 2014 to 15 June 2014")
+are recognised for gallery queries, together with quality words ("sharp",
+"blurry", "non-pink").
+"""
+
+import re
+import calendar
+from datetime import date
+
+MONTHS = {
+    name: i + 1
+    for i, names in enumerate([
+        ("january", "jan"), ("february", "feb"), ("march", "mar"), ("april", "apr"),
+        ("may",), ("june", "jun"), ("july", "jul"), ("august", "aug"),
+        ("september", "sep", "sept"), ("october", "oct"), ("november", "nov"), ("december", "dec"),
+    ])
+    for name in names
+}
+
+_MONTH = r"(?P<month_name>" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?"
+_DAY = r"(?P<day>\d{1,2})(?:st|nd|rd|th)?"
+_YEAR = r"(?P<year>\d{4})"
+
+# Tried in order; numeric day/month forms are read day-first (23/05/2014).
+DATE_PATTERNS = [
+    re.compile(r"\b(?P<year>\d{4})[-/.](?P<month>\d{1,2})[-/.](?P<day>\d{1,2})\b"),
+    re.compile(r"\b(?P<day>\d{1,2})[-/.](?P<month>\d{1,2})[-/.](?P<year>\d{4})\b"),
+    re.compile(rf"\b{_MONTH}\s+{_DAY}(?:\s*,)?\s+(?:of\s+)?{_YEAR}\b", re.IGNORECASE),
+    re.compile(rf"\b{_DAY}\s+(?:of\s+)?{_MONTH}(?:\s*,)?\s+{_YEAR}\b", re.IGNORECASE),
+]
+MONTH_YEAR_PATTERN = re.compile(rf"\b{_MONTH}(?:\s*,)?\s+(?:of\s+)?{_YEAR}\b", re.IGNORECASE)
+SEASONS = {"spring": (3, 5), "summer": (6, 8), "autumn": (9, 11), "fall": (9, 11)}
+SEASON_PATTERN = re.compile(r"\b(?P<season>spring|summer|autumn|fall)(?:\s+of)?\s+(?P<year>\d{4})\b", re.IGNORECASE)
+YEAR_PATTERN = re.compile(r"\b(?:in|during|for|of)\s+(?P<year>(?:19|20)\d{2})\b", re.IGNORECASE)
+LENS_PATTERN = re.compile(r"\bK(\d+)\b", re.IGNORECASE)
+ZOOM_PATTERN = re.compile(r"\b(1|10)\s*x\b", re.IGNORECASE)
+_NEGATION = r"\b(?:non|not|no|without)[- ]?"
+_SHARP = r"(?:sharp|in focus|focused|crisp)"
+_BLURRY = r"(?:blurry|blurred|blur|out of focus|unfocused)"
+NOT_PINK_PATTERN = re.compile(rf"{_NEGATION}pink\b", re.IGNORECASE)
+PINK_PATTERN = re.compile(r"\bpink\b", re.IGNORECASE)
+NOT_SHARP_PATTERN = re.compile(rf"{_NEGATION}{_SHARP}\b", re.IGNORECASE)
+NOT_BLURRY_PATTERN = re.compile(rf"{_NEGATION}{_BLURRY}\b", re.IGNORECASE)
+SHARP_PATTERN = re.compile(rf"\b{_SHARP}\b", re.IGNORECASE)
+BLURRY_PATTERN = re.compile(rf"\b{_BLURRY}\b", re.IGNORECASE)
+
+
+def parse_dates(text: str) -> list:
+    """Every date in `text` as 'YYYY-MM-DD', in the order they appear."""
+    found = []  # (start, end, iso)
+    for pattern in DATE_PATTERNS:
+        for m in pattern.finditer(text):
+            if any(m.start() < end and start < m.end() for start, end, _ in found):
+                continue  # already covered by an earlier pattern
+            parts = m.groupdict()
+            month = MONTHS[parts["month_name"].lower()] if parts.get("month_name") else int(parts["month"])
+            try:
+                iso = date(int(parts["year"]), month, int(parts["day"])).isoformat()
+            except ValueError:
+                continue
+            found.append((m.start(), m.end(), iso))
+    return [iso for _, _, iso in sorted(found)]
+
+
+def parse_date(text: str):
+    """First date found in `text` as 'YYYY-MM-DD', or None."""
+    dates = parse_dates(text)
+    return dates[0] if dates else None
+
+
+def parse_date_range(text: str):
+    """
+    (start, end) as inclusive 'YYYY-MM-DD' strings for a range query, or None.
+    Two explicit dates win, then "<month> <year>", "<season> <year>" and "in <year>".
+    A single explicit date is not a range.
+    """
+    dates = parse_dates(text)
+    if len(dates) >= 2:
+        return min(dates), max(dates)
+    if dates:
+        return None
+
+    m = MONTH_YEAR_PATTERN.search(text)
+    if m:
+        year, month = int(m.group("year")), MONTHS[m.group("month_name").lower()]
+        return date(year, month, 1).isoformat(), date(year, month, calendar.monthrange(year, month)[1]).isoformat()
+
+    m = SEASON_PATTERN.search(text)
+    if m:
+        year = int(m.group("year"))
+        first, last = SEASONS[m.group("season").lower()]
+        return date(year, first, 1).isoformat(), date(year, last, calendar.monthrange(year, last)[1]).isoformat()
+
+    m = YEAR_PATTERN.search(text)
+    if m:
+        year = int(m.group("year"))
+        return date(year, 1, 1).isoformat(), date(year, 12, 31).isoformat()
+    return None
+
+
+def parse_query(text: str) -> dict:
+    """{'date', 'lens', 'zoom'} extracted from `text`; missing fields are None."""
+    lens = LENS_PATTERN.search(text)
+    zoom = ZOOM_PATTERN.search(text)
+    return {
+        "date": parse_date(text),
+        "lens": f"K{lens.group(1)}" if lens else None,
+        "zoom": f"{zoom.group(1)}x" if zoom else None,
+    }
+
+
+def parse_range_query(text: str) -> dict:
+    """{'start_date', 'end_date', 'lens', 'zoom'} for a gallery query; missing fields are None."""
+    parsed = parse_query(text)
+    date_range = parse_date_range(text) or (None, None)
+    return {"start_date": date_range[0], "end_date": date_range[1], "lens": parsed["lens"], "zoom": parsed["zoom"]}
+
+
+def parse_quality_filters(text: str) -> dict:
+    """{'sharp', 'pink'} as True / False when the query asks for it, else None."""
+    pink = False if NOT_PINK_PATTERN.search(text) else (True if PINK_PATTERN.search(text) else None)
+    # Negated forms first: "not blurry" asks for sharp images, "not sharp" for blurry ones
+    if NOT_BLURRY_PATTERN.search(text):
+        sharp = True
+    elif NOT_SHARP_PATTERN.search(text):
+        sharp = False
+    elif SHARP_PATTERN.search(text):
+        sharp = True
+    elif BLURRY_PATTERN.search(text):
+        sharp = False
+    else:
+        sharp = None
+    return {"sharp": sharp, "pink": pink}
@@ -0,0 +1,171 @@
+"""
+remote_manifest.py
+
+Local manifest of the remote TARBIL tree, so an incremental sync only lists
+directories that actually changed.
+
+Every directory listing (`listdir_attr`: names, sizes, mtimes) is stored in
+SQLite together with the directory's own mtime and committed straight away,
+which doubles as a checkpoint: after a dropped connection or a crash the next
+run serves everything already listed from the manifest and carries on where
+the walk stopped.
+
+On later runs a directory is re-listed only if its mtime differs from the
+stored one. When the parent was just listed from the server the child's
+mtime is already known, so the check costs nothing; otherwise it is one
+`stat` round-trip instead of a full listing. Directories under years older
+than `frozen_before_year` are trusted without any check.
+"""
+
+import re
+import stat
+import time
+import socket
+import sqlite3
+import threading
+import paramiko
+from collections import namedtuple
+from sftp_pool import connection_alive
+
+Entry = namedtuple("Entry", "filename st_size st_mtime is_dir")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path      TEXT PRIMARY KEY,
+    mtime     INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    dir       TEXT NOT NULL,
+    name      TEXT NOT NULL,
+    size      INTEGER,
+    mtime     INTEGER,
+    is_dir    INTEGER NOT NULL,
+    PRIMARY KEY (dir, name)
+);
+"""
+
+_YEAR_SEGMENT = re.compile(r"^\d{4}$")
+
+
+class RemoteManifest:
+    """Thread-safe: the lister and the download workers share one instance."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, path):
+        """(mtime, [Entry]) recorded for `path`, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return None
+            entries = [
+                Entry(name, size, mtime, bool(is_dir))
+                for name, size, mtime, is_dir in self._conn.execute(
+                    "SELECT name, size, mtime, is_dir FROM entries WHERE dir = ? ORDER BY name", (path,))
+            ]
+        return row[0], entries
+
+    def update_file(self, path, name, size, mtime):
+        """Correct one file's recorded size / mtime, e.g. after it changed in a directory whose mtime did not."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE entries SET size = ?, mtime = ? WHERE dir = ? AND name = ?",
+                               (size, mtime, path, name))
+
+    def put(self, path, mtime, entries):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entries WHERE dir = ?", (path,))
+            self._conn.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                [(path, e.filename, e.st_size, e.st_mtime, int(e.is_dir)) for e in entries],
+            )
+            self._conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (path, mtime))
+
+
+class RemoteLister:
+    """
+    `listdir` / `listdir_attr` over SFTP, answered from a RemoteManifest
+    whenever the directory is unchanged. Owns its own connection and
+    reconnects if it drops. Without a manifest every call goes to the server.
+    `observer(stage, seconds)` is told how long each server round-trip took.
+    """
+
+    def __init__(self, connect, manifest=None, frozen_before_year=None, retries=3, observer=None):
+        self._connect = connect
+        self._retries = retries
+        self._observer = observer
+        self.manifest = manifest
+        self.frozen_before_year = frozen_before_year
+        self.client, self.sftp = connect()
+        self._hints = {}  # dir -> mtime seen in a fresh listing of its parent
+        self.stats = {"listed": 0, "from_manifest": 0, "stat_calls": 0, "reconnects": 0}
+
+    def close(self):
+        self.sftp.close()
+        self.client.close()
+
+    def _call(self, method, path):
+        for attempt in range(self._retries + 1):
+            try:
+                t0 = time.monotonic()
+                result = getattr(self.sftp, method)(path)
+                if self._observer:
+                    self._observer("listing", time.monotonic() - t0)
+                return result
+            except (paramiko.SSHException, EOFError, socket.error):
+                if connection_alive(self.client) or attempt == self._retries:
+                    raise
+                self.client.close()
+                self.client, self.sftp = self._connect()
+                self.stats["reconnects"] += 1
+
+    def _is_frozen(self, path) -> bool:
+        if self.frozen_before_year is None:
+            return False
+        years = [int(s) for s in path.split("/") if _YEAR_SEGMENT.match(s)]
+        return bool(years) and years[-1] < self.frozen_before_year
+
+    def listdir_attr(self, path):
+        hint = self._hints.pop(path, None)
+        cached = self.manifest.get(path) if self.manifest else None
+
+        if cached is not None:
+            cached_mtime, entries = cached
+            if hint is None and self._is_frozen(path):
+                self.stats["from_manifest"] += 1
+                return entries
+            if hint is None:
+                hint = self._call("stat", path).st_mtime
+                self.stats["stat_calls"] += 1
+            if hint == cached_mtime:
+                self.stats["from_manifest"] += 1
+                return entries
+
+        # Take the mtime before listing: if the directory changes meanwhile the
+        # next run sees a newer mtime and lists it again.
+        if hint is None and self.manifest is not None:
+            hint = self._call("stat", path).st_mtime
+            self.stats["stat_calls"] += 1
+        entries = [
+            Entry(a.filename, a.st_size, a.st_mtime, stat.S_ISDIR(a.st_mode or 0))
+            for a in self._call("listdir_attr", path)
+        ]
+        self.stats["listed"] += 1
+        if self.manifest is not None:
+            self.manifest.put(path, hint, entries)
+        for e in entries:
+            if e.is_dir:
+                self._hints[f"{path}/{e.filename}"] = e.st_mtime
+        return entries
+
+    def listdir(self, path):
+        return [e.filename for e in self.listdir_attr(path)]
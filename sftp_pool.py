@@ -0,0 +1,154 @@
+"""
+sftp_pool.py
+
+A pool of independent SFTP connections that fetch files concurrently from a
+shared work queue.
+
+Each worker thread owns one SSH connection (opened with a larger flow-control
+window than paramiko's default), takes jobs from a bounded queue and runs
+`fetch(sftp, job)` on them. If the connection dies the worker reconnects and
+retries the job. Per-connection and aggregate throughput are tracked.
+"""
+
+import time
+import queue
+import socket
+import threading
+import paramiko
+
+WINDOW_SIZE     = 64 * 1024 * 1024   # SSH channel window; default (2 MB) starves long fat links
+MAX_PACKET_SIZE = 256 * 1024
+
+
+def open_sftp(hostname, port, username, password, window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE):
+    """Open one SSH connection and an SFTP channel with a large window. Returns (client, sftp)."""
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname, port=port, username=username, password=password)
+    transport = client.get_transport()
+    transport.set_keepalive(30)
+    sftp = paramiko.SFTPClient.from_transport(transport, window_size=window_size, max_packet_size=max_packet_size)
+    return client, sftp
+
+
+def connection_alive(client) -> bool:
+    transport = client.get_transport() if client else None
+    return bool(transport and transport.is_active())
+
+
+class ConnectionStats:
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self.errors = 0
+        self.reconnects = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "connection": self.name,
+            "files": self.files,
+            "bytes": self.bytes,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+            "mb_per_s": round(self.bytes / self.busy_seconds / 1e6, 2) if self.busy_seconds else 0.0,
+        }
+
+
+class SFTPPool:
+    """
+    `connect()` must return a fresh (client, sftp) pair. `fetch(sftp, job)` does
+    the transfer and returns the number of bytes moved; an exception on a dead
+    connection triggers reconnect + retry, any other exception fails the job.
+    `on_error(job, exc)` is called for jobs that finally failed.
+    """
+
+    def __init__(self, connect, fetch, connections=4, max_queue=None, retries=3, on_error=None):
+        self._connect = connect
+        self._fetch = fetch
+        self._retries = retries
+        self._on_error = on_error
+        self._queue = queue.Queue(maxsize=max_queue or connections * 8)
+        self._started = time.monotonic()
+        self.stats = [ConnectionStats(f"sftp-{i}") for i in range(connections)]
+        self._threads = [
+            threading.Thread(target=self._worker, args=(s,), name=s.name, daemon=True)
+            for s in self.stats
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, job):
+        """Queue a job; blocks while the queue is full so memory stays bounded."""
+        self._queue.put(job)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        """Wait for all queued jobs, then shut the connections down."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _worker(self, stats):
+        client = sftp = None
+        try:
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                for attempt in range(self._retries + 1):
+                    try:
+                        if not connection_alive(client):
+                            if client is not None:
+                                client.close()
+                                stats.reconnects += 1
+                            client, sftp = self._connect()
+                        t0 = time.monotonic()
+                        n = self._fetch(sftp, job)
+                        stats.busy_seconds += time.monotonic() - t0
+                        stats.files += 1
+                        stats.bytes += n or 0
+                        break
+                    except (paramiko.SSHException, EOFError, socket.error) as e:
+                        # OSError covers both dropped sockets and plain remote file errors;
+                        # only retry when the connection itself is gone.
+                        if connection_alive(client) and not isinstance(e, (paramiko.SSHException, EOFError)):
+                            self._fail(stats, job, e)
+                            break
+                        if client is not None:
+                            client.close()
+                        client = None
+                        if attempt == self._retries:
+                            self._fail(stats, job, e)
+                        else:
+                            stats.reconnects += 1
+                            time.sleep(min(2 ** attempt, 30))
+                    except Exception as e:
+                        self._fail(stats, job, e)
+                        break
+        finally:
+            if client is not None:
+                client.close()
+
+    def _fail(self, stats, job, exc):
+        stats.errors += 1
+        if self._on_error:
+            self._on_error(job, exc)
+
+    def report(self) -> dict:
+        per_connection = [s.as_dict() for s in self.stats]
+        elapsed = time.monotonic() - self._started
+        total_bytes = sum(s.bytes for s in self.stats)
+        return {
+            "connections": per_connection,
+            "files": sum(s.files for s in self.stats),
+            "bytes": total_bytes,
+            "errors": sum(s.errors for s in self.stats),
+            "elapsed_s": round(elapsed, 1),
+            "mb_per_s": round(total_bytes / elapsed / 1e6, 2) if elapsed else 0.0,
+        }
@@ -0,0 +1,127 @@
+"""
+sync_metrics.py
+
+Live throughput / latency counters for download_all_years.py.
+
+Workers record listing latency, transfer and validation times, bytes and
+errors; a reporter thread prints a one-line snapshot (and optionally rewrites
+a JSON file) every few seconds, and the last `snapshot()` is the run summary.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import Counter
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+class LatencyTimer:
+    """Count / total / max plus the last `max_samples` samples for rolling percentiles. Not locked."""
+
+    def __init__(self, max_samples=10000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = []
+        self._max_samples = max_samples
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self._samples) < self._max_samples:
+            self._samples.append(seconds)
+        else:
+            self._samples[self.count % self._max_samples] = seconds
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)) -> dict:
+        ordered = sorted(self._samples)
+        return {q: _percentile(ordered, q) for q in qs}
+
+    def as_dict(self) -> dict:
+        q = self.quantiles()
+        return {
+            "count": self.count,
+            "total_s": round(self.total, 3),
+            "mean_ms": round(self.total / self.count * 1000, 1) if self.count else 0.0,
+            "p50_ms": round(q[0.5] * 1000, 1),
+            "p95_ms": round(q[0.95] * 1000, 1),
+            "p99_ms": round(q[0.99] * 1000, 1),
+            "max_ms": round(self.max * 1000, 1),
+        }
+
+
+class SyncMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+        self.errors = Counter()
+        self.timers = {name: LatencyTimer() for name in ("listing", "transfer", "validation", "scoring")}
+        self._queue_depth = None
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.timers.setdefault(stage, LatencyTimer()).add(seconds)
+
+    def record_file(self, nbytes: int) -> None:
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+
+    def record_error(self, kind: str) -> None:
+        with self._lock:
+            self.errors[kind] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                "elapsed_s": round(elapsed, 1),
+                "files": self.files,
+                "bytes": self.bytes,
+                "files_per_s": round(self.files / elapsed, 2) if elapsed else 0.0,
+                "mb_per_s": round(self.bytes / elapsed / 1e6, 2) if elapsed else 0.0,
+                "queue_depth": self._queue_depth() if self._queue_depth else None,
+                "errors": dict(self.errors),
+                "stages": {name: t.as_dict() for name, t in self.timers.items()},
+            }
+
+    def start_reporter(self, interval=10.0, queue_depth=None, json_path=None):
+        """Print a snapshot every `interval` s; also rewrite `json_path` if given."""
+        self._queue_depth = queue_depth
+
+        def run():
+            while not self._stop.wait(interval):
+                snap = self.snapshot()
+                print(f"[METRICS] {snap['files']} files  {snap['files_per_s']} files/s  "
+                      f"{snap['mb_per_s']} MB/s  queue {snap['queue_depth']}  "
+                      f"listing p95 {snap['stages']['listing']['p95_ms']} ms  errors {sum(snap['errors'].values())}")
+                if json_path:
+                    write_json(json_path, snap)
+
+        self._reporter = threading.Thread(target=run, name="sync-metrics", daemon=True)
+        self._reporter.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._reporter is not None:
+            self._reporter.join()
+
+
+def write_json(path, data) -> None:
+    """Replace `path` atomically so readers never see half a file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,44 @@
+import pytest
+
+from query_parser import parse_query, parse_range_query, parse_quality_filters
+
+
+@pytest.mark.parametrize("text, sharp", [
+    ("sharp images from May 2014", True),
+    ("images in focus", True),
+    ("not blurry images from May 2014", True),
+    ("non-blurry K2 10x", True),
+    ("images without blur", True),
+    ("blurry images from summer 2015", False),
+    ("out of focus shots", False),
+    ("unfocused shots", False),
+    ("not sharp images", False),
+    ("images that are not in focus", False),
+    ("images from May 2014", None),
+])
+def test_sharp_filter(text, sharp):
+    assert parse_quality_filters(text)["sharp"] is sharp
+
+
+@pytest.mark.parametrize("text, pink", [
+    ("pink images", True),
+    ("non-pink images", False),
+    ("not pink", False),
+    ("images without pink", False),
+    ("sharp images", None),
+])
+def test_pink_filter(text, pink):
+    assert parse_quality_filters(text)["pink"] is pink
+
+
+def test_filters_combine():
+    assert parse_quality_filters("not blurry, non-pink K2 images from May 2014") == {"sharp": True, "pink": False}
+
+
+def test_parse_query():
+    assert parse_query("May 23rd 2014 with K2 at 10x") == {"date": "2014-05-23", "lens": "K2", "zoom": "10x"}
+
+
+def test_parse_range_query():
+    parsed = parse_range_query("sharp K2 1x images from May 2014")
+    assert parsed == {"start_date": "2014-05-01", "end_date": "2014-05-31", "lens": "K2", "zoom": "1x"}
@@ -0,0 +1,129 @@
+"""
+thumbnails.py
+
+On-disk cache of downscaled JPEG previews for the app.
+
+Previews come in fixed sizes (PREVIEW_SIZES, longest side in pixels) and are
+keyed by source path, source mtime and size, so a replaced image gets a new
+preview automatically. JPEG sources are decoded with PIL's draft mode, which
+lets libjpeg scale by 1/2..1/8 during decode instead of decoding full
+resolution first. A running total of the cache size is kept, and only when
+it grows past `max_bytes` is the cache directory walked and trimmed,
+least-recently-used first, down to EVICT_TARGET of the limit.
+"""
+
+import os
+import hashlib
+import argparse
+import threading
+from PIL import Image
+from image_quality import is_image_file
+
+PREVIEW_SIZES = {"thumb": 320, "preview": 1280}
+DEFAULT_CACHE_DIR = ".thumbnails"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+JPEG_QUALITY = 85
+EVICT_TARGET = 0.9  # trim to this fraction of max_bytes so the next misses don't evict again
+
+
+class ThumbnailCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None  # bytes in the cache; counted on the first miss, then kept running
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, source, size_name, mtime_ns) -> str:
+        key = f"{os.path.abspath(source)}|{mtime_ns}|{size_name}".encode("utf-8")
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.jpeg")
+
+    def get(self, source, size_name="preview") -> str:
+        """Path of the cached preview for `source`, generating it on first use."""
+        if size_name not in PREVIEW_SIZES:
+            raise ValueError(f"Unknown preview size {size_name!r}; use one of {sorted(PREVIEW_SIZES)}")
+        cached = self._cache_path(source, size_name, os.stat(source).st_mtime_ns)
+        if os.path.exists(cached):
+            os.utime(cached)  # mark as recently used for eviction
+            return cached
+
+        self._render(source, cached, PREVIEW_SIZES[size_name])
+        if self._grow(os.path.getsize(cached)) > self.max_bytes:
+            self.evict()
+        return cached
+
+    def _grow(self, nbytes) -> int:
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, size, _ in self._entries())  # already includes nbytes
+            else:
+                self._total += nbytes
+            return self._total
+
+    def _render(self, source, dest, longest_side):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with Image.open(source) as img:
+            img.draft("RGB", (longest_side, longest_side))
+            img = img.convert("RGB")
+            img.thumbnail((longest_side, longest_side), Image.Resampling.LANCZOS)
+            tmp_path = f"{dest}.{threading.get_ident()}.tmp"
+            img.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        os.replace(tmp_path, dest)
+
+    def _entries(self):
+        """(mtime, size, path) of every file in the cache."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self) -> int:
+        """If the cache is over max_bytes, delete least-recently-used previews down to EVICT_TARGET of it."""
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            target = self.max_bytes * EVICT_TARGET if total > self.max_bytes else total
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            self._total = total
+            return removed
+
+    def warm(self, root, size_names=tuple(PREVIEW_SIZES)) -> int:
+        """Generate previews for every image under `root` ahead of time."""
+        count = 0
+        for dirpath, _, filenames in os.walk(root):
+            for f in filenames:
+                if is_image_file(f):
+                    for size_name in size_names:
+                        try:
+                            self.get(os.path.join(dirpath, f), size_name)
+                            count += 1
+                        except Exception as e:
+                            print(f"ERROR creating preview for {os.path.join(dirpath, f)}: {e}")
+        return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate preview images for the app.")
+    parser.add_argument("root", nargs="?", default="./47.04")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3)
+    args = parser.parse_args()
+
+    cache = ThumbnailCache(args.cache_dir, int(args.max_gb * 1024 ** 3))
+    print(f"{cache.warm(args.root)} previews ready in {args.cache_dir}")
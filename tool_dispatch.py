@@ -0,0 +1,109 @@
+"""
+tool_dispatch.py
+
+Generic execution layer for LLM tool calls.
+
+Tools are registered with their JSON schema and an optional TTL. All tool
+calls from one model response are run concurrently on a shared thread pool
+and the results come back in the order the model asked for them. A tool with
+a TTL is wrapped in `ttl_cache`, so repeating a question within the TTL does
+not repeat the underlying HTTP request.
+"""
+
+import json
+import time
+import inspect
+import threading
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ttl_cache(ttl: float, maxsize: int = 256):
+    """
+    Memoize a function for `ttl` seconds. Arguments are normalised through the
+    function signature (so f("Paris") and f(city="Paris", metric="celsius")
+    share an entry). Exceptions and dict results with an "error" key are not cached.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        entries = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = tuple(sorted(bound.arguments.items()))
+            now = time.monotonic()
+            with lock:
+                hit = entries.get(key)
+                if hit is not None and hit[0] > now:
+                    entries.move_to_end(key)
+                    return hit[1]
+
+            result = fn(*args, **kwargs)
+            if not (isinstance(result, dict) and "error" in result):
+                with lock:
+                    entries[key] = (now + ttl, result)
+                    entries.move_to_end(key)
+                    while len(entries) > maxsize:
+                        entries.popitem(last=False)
+            return result
+
+        def cache_clear():
+            with lock:
+                entries.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
+class ToolRegistry:
+    def __init__(self, max_workers: int = 8):
+        self._tools = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+
+    def register(self, schema: dict, ttl: float = None):
+        """Decorator: expose `fn` to the model under schema["function"]["name"]."""
+        def decorator(fn):
+            impl = ttl_cache(ttl)(fn) if ttl else fn
+            self._tools[schema["function"]["name"]] = (impl, schema)
+            return impl
+        return decorator
+
+    @property
+    def schemas(self) -> list:
+        return [schema for _, schema in self._tools.values()]
+
+    def _call(self, tool_call):
+        fn_name = tool_call["function"]["name"]
+        args = tool_call["function"].get("arguments") or {}
+        if isinstance(args, str):
+            try:
+                args = json.loads(args)
+            except json.JSONDecodeError:
+                return None  # malformed arguments count as bad arguments
+        if fn_name not in self._tools:
+            return None
+        fn, _ = self._tools[fn_name]
+        try:
+            inspect.signature(fn).bind(**args)
+        except TypeError:
+            return None
+        try:
+            result = fn(**args)
+        except Exception as e:
+            result = {"error": str(e)}
+        return {"role": "tool", "name": fn_name, "content": json.dumps(result)}
+
+    def dispatch(self, tool_calls) -> list:
+        """
+        Run all `tool_calls` concurrently. Returns one tool message per call, in
+        call order; unknown tools or calls with bad arguments yield None.
+        """
+        return list(self._executor.map(self._call, tool_calls))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
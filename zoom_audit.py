@@ -0,0 +1,257 @@
+"""
+zoom_audit.py
+
+Batch YOLO zoom classification of the whole archive.
+
+Images are fed to the `best.pt` classifier in fixed-size batches, optionally
+through an exported ONNX or OpenVINO model for CPU throughput. The predicted
+class and confidence of every image are kept in a SQLite store keyed by path
+and mtime, which the app reads before running the model itself, and which
+lists every image whose prediction disagrees with its 1X/10X folder.
+"""
+
+import os
+import sqlite3
+import threading
+import argparse
+from image_quality import is_image_file
+from duplicate_index import DuplicateIndex
+
+YOLO_MODEL_PATH = "./best.pt"
+DEFAULT_DB = "zoom_predictions.sqlite"
+RUNTIMES = ("torch", "onnx", "openvino")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    path        TEXT PRIMARY KEY,
+    mtime_ns    INTEGER NOT NULL,
+    expected    TEXT,
+    predicted   TEXT NOT NULL,
+    confidence  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_predictions_expected ON predictions (expected, predicted);
+"""
+
+
+def _key(path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def expected_zoom_for(path):
+    """Zoom implied by the archive folder (…/<lens>/10X/file.jpeg -> '10x'), or None."""
+    folder = os.path.basename(os.path.dirname(os.path.abspath(path))).lower()
+    return folder if folder.endswith("x") and folder[:-1].isdigit() else None
+
+
+class ZoomPredictionStore:
+    """Thread-safe prediction store shared by the batch job and the app."""
+
+    def __init__(self, db_path=DEFAULT_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, path, st=None):
+        """Stored prediction for `path`, or None if missing or the file changed."""
+        st = st or os.stat(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mtime_ns, expected, predicted, confidence FROM predictions WHERE path = ?",
+                (_key(path),),
+            ).fetchone()
+        if row is None or row[0] != st.st_mtime_ns:
+            return None
+        return {"expected": row[1], "predicted_zoom": row[2], "confidence": row[3]}
+
+    def put_many(self, rows):
+        """rows: iterable of (path, stat, expected, predicted, confidence)."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                [(_key(p), st.st_mtime_ns, exp, pred, conf) for p, st, exp, pred, conf in rows],
+            )
+            self._conn.commit()
+
+    def mismatches(self, min_confidence=0.0):
+        """Images whose predicted zoom disagrees with their folder, most confident first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, expected, predicted, confidence FROM predictions "
+                "WHERE expected IS NOT NULL AND predicted != expected AND confidence >= ? "
+                "ORDER BY confidence DESC",
+                (min_confidence,),
+            ).fetchall()
+        return [dict(zip(("path", "expected", "predicted_zoom", "confidence"), r)) for r in rows]
+
+
+def load_model(model_path=YOLO_MODEL_PATH, runtime="torch"):
+    """
+    Load the zoom classifier. For 'onnx' / 'openvino' the model is exported
+    next to `model_path` on first use (dynamic batch axis) and reused after.
+    """
+    from ultralytics import YOLO
+
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown runtime {runtime!r}; use one of {RUNTIMES}")
+    if runtime == "torch":
+        return YOLO(model_path)
+
+    stem = os.path.splitext(model_path)[0]
+    exported = f"{stem}.onnx" if runtime == "onnx" else f"{stem}_openvino_model"
+    if not os.path.exists(exported):
+        exported = YOLO(model_path).export(format=runtime, dynamic=True)
+    return YOLO(exported, task="classify")
+
+
+def _prediction(result):
+    return result.names[result.probs.top1].lower(), float(result.probs.top1conf)
+
+
+def classify_batch(model, sources, batch_size=32):
+    """[(predicted_zoom, confidence)] for a list of decoded arrays, in input order."""
+    results = model(sources, batch=batch_size, verbose=False)
+    return [_prediction(r) for r in results]
+
+
+def classify_paths(model, paths, batch_size=32):
+    """
+    {path: (predicted_zoom, confidence)} for image files. Results are matched
+    by `r.path`, not position: Ultralytics may skip an unreadable file with
+    only a warning, and a missing path is simply left out.
+    """
+    wanted = {_key(p): p for p in paths}
+    predictions = {}
+    for r in model(list(paths), batch=batch_size, verbose=False):
+        path = wanted.get(_key(r.path))
+        if path is not None:
+            predictions[path] = _prediction(r)
+    return predictions
+
+
+class SharedModel:
+    """
+    Zoom classifier shared by threads. The model is loaded on first use, by
+    whichever thread needs it, and calls are serialized: an Ultralytics model
+    keeps its predictor state on the instance and is not safe to run from
+    several threads at once.
+    """
+
+    def __init__(self, model_path=YOLO_MODEL_PATH, runtime="torch"):
+        self.model_path = model_path
+        self.runtime = runtime
+        self._lock = threading.Lock()
+        self._model = None
+
+    def classify(self, source):
+        """(predicted_zoom, confidence) for one path or decoded array."""
+        with self._lock:
+            if self._model is None:
+                self._model = load_model(self.model_path, self.runtime)
+            return classify_batch(self._model, [source], batch_size=1)[0]
+
+
+def _original_prediction(duplicates, store, image_path, st):
+    try:
+        original = duplicates.original_of(image_path, st)
+        return store.get(original) if original is not None else None
+    except (OSError, ValueError):
+        return None
+
+
+def classify_archive(root_folder, store, model, batch_size=32, force=False, duplicates=None):
+    """
+    Classify every new or modified image under `root_folder` and record the
+    results. With a DuplicateIndex, a near duplicate of an already classified
+    image takes over its prediction instead of going through the model.
+    """
+    summary = {"classified": 0, "unchanged": 0, "duplicates": 0, "errors": 0}
+    batch = []
+
+    def flush():
+        paths = [p for p, _ in batch]
+        try:
+            predictions = classify_paths(model, paths, batch_size)
+        except Exception as e:
+            # Older Ultralytics versions raise on one unreadable file; retry one
+            # by one so only that file fails
+            print(f"WARNING batch starting at {paths[0]} failed ({e}); classifying its images one by one")
+            predictions, failures = {}, {}
+            for p in paths:
+                try:
+                    predictions.update(classify_paths(model, [p], 1))
+                except Exception as e:
+                    failures[p] = e
+        else:
+            failures = {}
+        for p in paths:
+            if p not in predictions:
+                summary["errors"] += 1
+                print(f"ERROR classifying {p}: {failures.get(p, 'unreadable, skipped by the model')}")
+        store.put_many((p, st, expected_zoom_for(p), *predictions[p]) for p, st in batch if p in predictions)
+        summary["classified"] += len(predictions)
+        batch.clear()
+
+    for dirpath, dirnames, filenames in os.walk(root_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not is_image_file(filename):
+                continue
+            image_path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(image_path)
+            except OSError as e:  # removed while the walk was running
+                summary["errors"] += 1
+                print(f"ERROR reading {image_path}: {e}")
+                continue
+            if not force and store.get(image_path, st) is not None:
+                summary["unchanged"] += 1
+                continue
+            if duplicates is not None:
+                original = _original_prediction(duplicates, store, image_path, st)
+                if original is not None:
+                    store.put_many([(image_path, st, expected_zoom_for(image_path),
+                                     original["predicted_zoom"], original["confidence"])])
+                    summary["duplicates"] += 1
+                    continue
+            batch.append((image_path, st))
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify the zoom level of every archive image.")
+    parser.add_argument("root", nargs="?", default="./47.04")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--model", default=YOLO_MODEL_PATH)
+    parser.add_argument("--runtime", default="torch", choices=RUNTIMES)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--force", action="store_true", help="Re-classify unchanged images too")
+    parser.add_argument("--dedupe", metavar="DB",
+                        help="Perceptual-hash index; near duplicates reuse the prediction of their original")
+    args = parser.parse_args()
+
+    with ZoomPredictionStore(args.db) as store:
+        model = load_model(args.model, args.runtime)
+        duplicates = DuplicateIndex(args.dedupe) if args.dedupe else None
+        print(classify_archive(args.root, store, model, args.batch_size, args.force, duplicates))
+        if duplicates is not None:
+            duplicates.close()
+        for row in store.mismatches():
+            print(f"MISFILED: {row['path']} in {row['expected']} folder, "
+                  f"predicted {row['predicted_zoom']} ({row['confidence']:.2f})")